@@ -0,0 +1,184 @@
+import json
+import os
+import subprocess
+import threading
+import time
+import types
+
+import nacl.orchestrators
+import nacl.state
+
+
+class FakeContainer:
+    def __init__(self, client: "FakeDockerClient", name: str, labels: dict) -> None:
+        self.client = client
+        self.name = name
+        self.labels = labels
+        self.status = "running"
+
+    def start(self) -> None:
+        self.client.call()
+        self.status = "running"
+
+    def remove(self, force: bool = False) -> None:
+        self.client.call()
+        self.client.containers.items.pop(self.name, None)
+
+    def exec_run(self, cmd, **kwargs):
+        self.client.call()
+        return types.SimpleNamespace(exit_code=0, output=b"")
+
+    def commit(self, repository: str, tag: str) -> None:
+        self.client.call()
+
+
+class FakeContainers:
+    def __init__(self, client: "FakeDockerClient") -> None:
+        self.client = client
+        self.items: dict[str, FakeContainer] = {}
+
+    def list(self, all: bool = False, filters: dict = {}):
+        self.client.call()
+        found = []
+        for cont in self.items.values():
+            if not all and cont.status != "running":
+                continue
+            if "name" in filters and filters["name"] not in cont.name:
+                continue
+            if "status" in filters and cont.status != filters["status"]:
+                continue
+            labels = filters.get("label", [])
+            if any(cont.labels.get(x.split("=")[0]) != x.split("=")[1] for x in labels):
+                continue
+            found.append(cont)
+        return found
+
+    def run(self, name: str, labels: dict = {}, **kwargs) -> FakeContainer:
+        self.client.call()
+        self.items[name] = FakeContainer(self.client, name, labels)
+        return self.items[name]
+
+
+class FakeNetwork:
+    def __init__(self, client: "FakeDockerClient") -> None:
+        self.client = client
+
+    def connect(self, container, aliases=[]) -> None:
+        self.client.call()
+
+    def remove(self) -> None:
+        self.client.call()
+
+
+class FakeNetworks:
+    def __init__(self, client: "FakeDockerClient") -> None:
+        self.client = client
+        self.names: list[str] = []
+
+    def list(self, names=[]):
+        self.client.call()
+        return [FakeNetwork(self.client) for x in names if x in self.names]
+
+    def create(self, name: str) -> FakeNetwork:
+        self.client.call()
+        self.names.append(name)
+        return FakeNetwork(self.client)
+
+
+class FakeImages:
+    def __init__(self, client: "FakeDockerClient") -> None:
+        self.client = client
+
+    def get(self, name: str):
+        self.client.call()
+        raise FakeErrors.ImageNotFound(name)
+
+
+class FakeErrors:
+    class ImageNotFound(Exception):
+        pass
+
+
+class FakeDockerClient:
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.containers = FakeContainers(self)
+        self.networks = FakeNetworks(self)
+        self.images = FakeImages(self)
+
+    def call(self) -> None:
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+def fake_docker_module(client: FakeDockerClient) -> types.ModuleType:
+    module = types.ModuleType("docker")
+    module.from_env = lambda: client  # type: ignore[attr-defined]
+    module.errors = FakeErrors  # type: ignore[attr-defined]
+    return module
+
+
+def state_return(minion: str, states: int) -> bytes:
+    ret = {}
+    for i in range(states):
+        ret[f"file_|-state{i}_|-/tmp/state{i}_|-managed"] = {
+            "__id__": f"state{i}",
+            "__sls__": "bench",
+            "__run_num__": i,
+            "name": f"/tmp/state{i}",
+            "result": True,
+            "changes": {},
+            "duration": 1.5,
+            "comment": "File /tmp/state{i} is in the correct state",
+        }
+    return json.dumps({minion: ret}, indent=4).encode()
+
+
+# in-process orchestrator, registered as provider "fake" by the benchmarks
+class Fake(nacl.orchestrators.Orchestrator):
+    __conf_schema__ = {
+        "image": {"type": str, "required": True},
+        "converge": {"type": bool, "required": False},
+    }
+    latency = 0.0
+    states = 20
+
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        self.scenario_dir = f"{self.config['running_tmp_dir']}fake/{self.config['formula']}/{self.config['scenario']}/nacl/"
+        self.formula_dir = f"{self.config['running_tmp_dir']}/formulas"
+        self.master_name = f"nacl_{self.config['formula']}_{self.config['scenario']}_master"
+        self.created = False
+
+    def orchestrate(self) -> dict[str, str]:
+        time.sleep(self.latency)
+        os.makedirs(self.scenario_dir, exist_ok=True)
+        created = {} if self.created else {x["prov_name"].split("_")[-1]: nacl.state.CREATED for x in self.config["instances"]}
+        self.created = True
+        return created
+
+    def cleanup(self) -> None:
+        time.sleep(self.latency)
+        nacl.state.StateStore().remove_scenario(self.config)
+        self.created = False
+
+    def get_inventory(self) -> list[tuple[str, str]]:
+        status = "Created" if self.created else "Not created"
+        return [(x["prov_name"].split("_")[-1], status) for x in self.config["instances"]]
+
+    def login(self, host: str) -> None:
+        pass
+
+    def exec(self, name: str, cmd: str, output=None) -> subprocess.CompletedProcess:
+        time.sleep(self.latency)
+        minions = cmd.split("'")[1].split(",") if "'" in cmd else [cmd.split(" ")[1]]
+        data = b"\n".join(state_return(x, self.states) for x in minions)
+        if output is not None:
+            for line in data.splitlines(keepends=True):
+                output(line)
+            return subprocess.CompletedProcess(cmd, 0)
+        return subprocess.CompletedProcess(cmd, 0, data, b"")
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# Benchmarks that run without Docker or Vagrant.
+#
+#   python benchmarks/run.py --output bench.json [--compare old.json]
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+# nacl.config reads HOME at import time, keep everything out of the real ~/.nacl
+WORK_DIR = tempfile.mkdtemp(prefix="nacl-bench-")
+os.environ["HOME"] = WORK_DIR
+sys.path.insert(0, REPO_DIR)
+
+import fakes  # noqa: E402
+import nacl.cli  # noqa: E402
+import nacl.config  # noqa: E402
+import nacl.orchestrators  # noqa: E402
+import nacl.utils  # noqa: E402
+
+
+def measure(func: Callable, repeat: int, setup: Callable = lambda: None) -> dict:
+    runs = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        func()
+        runs.append(time.perf_counter() - start)
+    return {
+        "runs": repeat,
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "mean": statistics.mean(runs),
+    }
+
+
+@contextmanager
+def quiet():
+    with open(os.devnull, "w") as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            yield
+        finally:
+            sys.stdout = stdout
+
+
+def scenario_config(provider: str, instances: int, scenario: str = "default") -> dict:
+    return {
+        "provider": {"name": provider},
+        "formula": "bench",
+        "scenario": scenario,
+        "verifier": "testinfra",
+        "master_config": {},
+        "salt_exec_mode": "salt-master",
+        "grains": {f"box{i}": {"roles": ["web"]} for i in range(instances)},
+        "instances": [{"name": f"box{i}", "image": "salt:3006"} for i in range(instances)],
+    }
+
+
+def make_formula(path: str, files: int) -> None:
+    for i in range(files):
+        state_dir = f"{path}/state{i // 50}"
+        os.makedirs(state_dir, exist_ok=True)
+        with open(f"{state_dir}/file{i}.sls", "w") as f:
+            f.write(f"state{i}:\n  file.managed:\n    - name: /tmp/{i}\n" * 20)
+
+
+def bench_cli_startup(repeat: int) -> dict:
+    results = {}
+    for name, cmd in {
+        "import": [sys.executable, "-c", "import nacl.cli"],
+        "help": [sys.executable, f"{REPO_DIR}/bin/nacl", "--help"],
+    }.items():
+        results[name] = measure(
+            lambda: subprocess.run(
+                cmd, capture_output=True, cwd=REPO_DIR, check=True,
+                env={**os.environ, "PYTHONPATH": REPO_DIR},
+            ),
+            repeat,
+        )
+    return results
+
+
+def bench_parse_config(repeat: int) -> dict:
+    results = {}
+    for instances in (10, 100, 1000):
+        raw = scenario_config("docker", instances)
+        results[f"instances={instances}"] = measure(
+            lambda: nacl.config.parse_config(json.loads(json.dumps(raw))), repeat
+        )
+    return results
+
+
+def bench_copy_srv_dir(repeat: int) -> dict:
+    results = {}
+    for files in (100, 1000, 5000):
+        src = f"{WORK_DIR}/formula-{files}"
+        make_formula(src, files)
+        tmp_dir = f"{WORK_DIR}/sync-{files}/"
+
+        def clean():
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        def touch_one():
+            with open(f"{src}/state0/file0.sls", "a") as f:
+                f.write("# edit\n")
+
+        copy = lambda: nacl.utils.copy_srv_dir(tmp_dir, "bench", src, "copy")
+        results[f"files={files},cold"] = measure(copy, repeat, clean)
+        results[f"files={files},unchanged"] = measure(copy, repeat)
+        results[f"files={files},one_changed"] = measure(copy, repeat, touch_one)
+    return results
+
+
+def bench_inventory(repeat: int, latency: float) -> dict:
+    results = {}
+    real_docker = sys.modules.get("docker")
+    try:
+        for instances in (1, 10, 100):
+            client = fakes.FakeDockerClient(latency)
+            sys.modules["docker"] = fakes.fake_docker_module(client)
+            config = nacl.config.parse_config(scenario_config("docker", instances))
+            orch = nacl.orchestrators.Docker(config)
+            for instance in config["instances"]:
+                client.containers.run(
+                    name=instance["prov_name"],
+                    labels={"app": "nacl", "formula": "bench", "scenario": "default"},
+                )
+            client.calls = 0
+            cold = measure(orch.get_inventory, repeat, orch.invalidate_inventory)
+            cold["api_calls"] = client.calls / repeat
+            client.calls = 0
+            warm = measure(orch.get_inventory, repeat)
+            warm["api_calls"] = client.calls / repeat
+            results[f"instances={instances},cold"] = cold
+            results[f"instances={instances},cached"] = warm
+    finally:
+        if real_docker is not None:
+            sys.modules["docker"] = real_docker
+        else:
+            sys.modules.pop("docker", None)
+    return results
+
+
+def bench_phases(repeat: int, latency: float) -> dict:
+    results = {}
+    cur_dir = f"{WORK_DIR}/repo"
+    fakes.Fake.latency = latency
+    nacl.orchestrators.Fake = fakes.Fake  # type: ignore[attr-defined]
+    for instances in (1, 5, 20):
+        config = scenario_config("fake", instances)
+        config["phases"] = ["destroy", "create", "prepare", "converge", "idempotence", "destroy"]
+        os.makedirs(f"{cur_dir}/nacl/default", exist_ok=True)
+        with open(f"{cur_dir}/nacl/default/nacl.yml", "w") as f:
+            json.dump(config, f)
+        args = argparse.Namespace(formula_synced=False)
+
+        def pipeline():
+            with quiet():
+                nacl.cli.test_scenario(args, cur_dir, "default")
+
+        os.chdir(cur_dir)
+        try:
+            results[f"instances={instances}"] = measure(pipeline, repeat)
+        finally:
+            os.chdir(REPO_DIR)
+    return results
+
+
+def git_commit() -> str:
+    proc = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], capture_output=True, cwd=REPO_DIR
+    )
+    return proc.stdout.decode().strip()
+
+
+def compare(old: dict, new: dict) -> None:
+    print(f"> Comparing {old.get('commit')} -> {new.get('commit')}")
+    for group, cases in new["benchmarks"].items():
+        for case, result in cases.items():
+            before = old["benchmarks"].get(group, {}).get(case)
+            if before is None:
+                continue
+            ratio = result["median"] / before["median"] if before["median"] else 0
+            print(f"{group}.{case}".ljust(50), f"{before['median'] * 1000:9.2f}ms", f"{result['median'] * 1000:9.2f}ms", f"{ratio:6.2f}x")
+
+
+BENCHMARKS = {
+    "cli_startup": lambda args: bench_cli_startup(args.repeat),
+    "parse_config": lambda args: bench_parse_config(args.repeat),
+    "copy_srv_dir": lambda args: bench_copy_srv_dir(args.repeat),
+    "inventory": lambda args: bench_inventory(args.repeat, args.latency),
+    "phases": lambda args: bench_phases(args.repeat, args.latency),
+}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="nacl benchmarks")
+    parser.add_argument("-o", "--output", default="bench_output.json", help="where to write the JSON results")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="runs per case")
+    parser.add_argument("-l", "--latency", type=float, default=0.002, help="seconds added to every fake docker/orchestrator call")
+    parser.add_argument("-c", "--compare", help="previous results file to compare against")
+    parser.add_argument("benchmarks", nargs="*", default=list(BENCHMARKS), help="benchmarks to run")
+    args = parser.parse_args()
+    output = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "timestamp": time.time(),
+        "latency": args.latency,
+        "benchmarks": {},
+    }
+    try:
+        for name in args.benchmarks:
+            print(f"> Running {name}")
+            output["benchmarks"][name] = BENCHMARKS[name](args)
+            for case, result in output["benchmarks"][name].items():
+                print(f"==> {case}".ljust(40), f"median {result['median'] * 1000:.2f}ms")
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), output)
+
+
+if __name__ == "__main__":
+    main()
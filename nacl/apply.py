@@ -0,0 +1,189 @@
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+import nacl.orchestrators
+import nacl.results
+import nacl.utils
+
+
+@dataclass
+class ApplyResult:
+    name: str
+    returncode: int
+    log_file: Optional[str] = None
+    result: nacl.results.InstanceResult = field(default_factory=nacl.results.InstanceResult)
+
+    @property
+    def succeeded(self) -> bool:
+        return (
+            self.returncode == 0
+            and self.result.errors == []
+            and self.result.failed == []
+        )
+
+
+class Progress:
+    def __init__(self, names: list[str], phase: str) -> None:
+        self.phase = phase
+        self.started = {x: time.monotonic() for x in names}
+        self.lines = {x: 0 for x in names}
+        self.done: dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.last_draw = 0.0
+        self.live = sys.stdout.isatty()
+
+    def update(self, name: str, lines: int) -> None:
+        with self.lock:
+            self.lines[name] = lines
+            if time.monotonic() - self.last_draw > 0.2:
+                self.draw()
+
+    def finish(self, name: str, returncode: int) -> None:
+        with self.lock:
+            self.done[name] = returncode
+            if not self.live:
+                print(f"==> {self.phase} finished on {name} in {time.monotonic() - self.started[name]:.1f}s (exit code {returncode})")
+            self.draw()
+
+    def draw(self) -> None:
+        self.last_draw = time.monotonic()
+        if not self.live:
+            return
+        status = []
+        for name, started in self.started.items():
+            if name in self.done:
+                status.append(f"{name}: {'ok' if self.done[name] == 0 else 'rc=' + str(self.done[name])}")
+            else:
+                status.append(f"{name}: {time.monotonic() - started:.0f}s {self.lines[name]} lines")
+        sys.stdout.write(f"\r\033[K==> {self.phase}: {' | '.join(status)}")
+        sys.stdout.flush()
+
+    def clear(self) -> None:
+        if self.live:
+            sys.stdout.write("\r\033[K")
+            sys.stdout.flush()
+
+
+class OutputLog:
+    def __init__(self, path: str, name: str, progress: Progress) -> None:
+        self.file = open(path, "wb")
+        self.name = name
+        self.progress = progress
+        self.lines = 0
+
+    def __call__(self, line: bytes) -> None:
+        self.file.write(line)
+        self.lines += 1
+        self.progress.update(self.name, self.lines)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def short_name(instance: dict) -> str:
+    return instance["prov_name"].split("_")[-1]
+
+
+def log_dir(config: dict) -> str:
+    path = f"{config['running_tmp_dir']}/{config['provider']['name']}/{config['formula']}/{config['scenario']}/logs"
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def pick_result(minions: dict, instance: dict, log_file: str) -> nacl.results.InstanceResult:
+    for minion in (instance["prov_name"], short_name(instance)):
+        if minion in minions:
+            return minions[minion]
+    return nacl.results.InstanceResult(
+        errors=[f"no state return from {short_name(instance)}, see {log_file}"]
+    )
+
+
+def apply_command(
+    config: dict,
+    orch: nacl.orchestrators.Orchestrator,
+    instances: list[dict],
+    state: str,
+    output: OutputLog,
+    parallelism: Optional[int] = None,
+    test: bool = False,
+) -> int:
+    state_args = f"{state} test=True" if test else state
+    if config["salt_exec_mode"] == "salt-master":
+        orch.refresh_pillar_top()
+        # one list targeted job, the master does the fan out to the minions
+        targets = ",".join(orch.minion_id(x) for x in instances)
+        batch = f" --batch-size {config['batch_size']}" if "batch_size" in config else ""
+        return orch.exec(
+            orch.master_name,
+            f"salt -L '{targets}' --out=json --static{batch} state.apply {state_args}",
+            output=output,
+        ).returncode
+    # a single salt-ssh run over the roster, it opens the ssh connections
+    # in parallel and only deploys the thin tarball to hosts that lack it
+    targets = ",".join(x["prov_name"] for x in instances)
+    max_procs = f" --max-procs {max(1, parallelism)}" if parallelism else ""
+    return nacl.utils.stream_process(
+        f"salt-ssh -L '{targets}' --saltfile={orch.scenario_dir}Saltfile -i --out=json --static{max_procs} state.sls {state_args}",
+        output,
+    )
+
+
+def apply_batch(
+    config: dict,
+    orch: nacl.orchestrators.Orchestrator,
+    instances: list[dict],
+    state: str,
+    phase: str,
+    parallelism: Optional[int] = None,
+    test: bool = False,
+) -> dict[str, ApplyResult]:
+    prefix = "master" if config["salt_exec_mode"] == "salt-master" else "salt-ssh"
+    log_file = f"{log_dir(config)}/{prefix}-{phase}.log"
+    progress = Progress([f"{len(instances)} minions"], phase)
+    output = OutputLog(log_file, f"{len(instances)} minions", progress)
+    try:
+        returncode = apply_command(config, orch, instances, state, output, parallelism, test)
+    finally:
+        output.close()
+    progress.finish(f"{len(instances)} minions", returncode)
+    progress.clear()
+    # only the parsed summary outlives this function, the raw output stays
+    # in the log file
+    with open(log_file, "r", errors="replace") as log:
+        minions = nacl.results.parse_output(log.read())
+    results = {}
+    for instance in instances:
+        result = pick_result(minions, instance, log_file)
+        # there is only one exit code for the whole job
+        results[short_name(instance)] = ApplyResult(
+            short_name(instance),
+            0 if result.errors == [] and result.failed == [] else 1,
+            log_file,
+            result,
+        )
+    return results
+
+
+def apply_states(
+    config: dict,
+    orch: nacl.orchestrators.Orchestrator,
+    instances: list[dict],
+    state: str,
+    phase: str = "apply",
+    parallelism: Optional[int] = None,
+    test: bool = False,
+) -> dict[str, ApplyResult]:
+    if instances == []:
+        return {}
+    if parallelism is None:
+        parallelism = config.get("apply_parallelism")
+    results = apply_batch(config, orch, instances, state, phase, parallelism, test)
+    # keep the mapping in the order instances are declared in nacl.yml
+    for instance in instances:
+        print(nacl.results.format_report(short_name(instance), results[short_name(instance)].result))
+    return results
@@ -0,0 +1,473 @@
+import asyncio
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+import types
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable, Optional
+
+import nacl.docker_api
+import nacl.orchestrators
+import nacl.state
+import nacl.timings
+from nacl.exceptions import ConfigException, OrchestrationTimeout
+
+
+async def wait_for(
+    check: Callable[[], Awaitable[bool]],
+    message: str,
+    timeout: float = 300,
+    delay: float = 0.2,
+    max_delay: float = 2.0,
+) -> None:
+    deadline = time.monotonic() + timeout
+    while not await check():
+        if time.monotonic() >= deadline:
+            raise OrchestrationTimeout(f"Timed out after {timeout}s waiting for {message}")
+        await asyncio.sleep(min(delay, max(0, deadline - time.monotonic())))
+        delay = min(delay * 2, max_delay)
+
+
+class LineBuffer:
+    # hands complete lines to the output callback, or collects everything
+    # when there is none
+    def __init__(self, output: Optional[Callable[[bytes], None]]) -> None:
+        self.output = output
+        self.data: list[bytes] = []
+        self.partial = b""
+
+    def feed(self, chunk: bytes) -> None:
+        if self.output is None:
+            self.data.append(chunk)
+            return
+        lines = (self.partial + chunk).split(b"\n")
+        self.partial = lines.pop()
+        for line in lines:
+            self.output(line + b"\n")
+
+    def close(self) -> bytes:
+        if self.output is not None and self.partial != b"":
+            self.output(self.partial)
+        return b"".join(self.data)
+
+
+class AsyncOrchestrator(ABC):
+    connection_type = ""
+
+    @abstractmethod
+    async def orchestrate(self) -> dict[str, str]:
+        pass
+
+    @abstractmethod
+    async def cleanup(self) -> None:
+        pass
+
+    @abstractmethod
+    async def get_inventory(self) -> list[tuple[str]]:
+        pass
+
+    @abstractmethod
+    async def exec(
+        self, name: str, cmd: str, output=None, timeout: Optional[float] = None
+    ) -> subprocess.CompletedProcess:
+        pass
+
+    @abstractmethod
+    def login(self, host: str) -> None:
+        # host is always set, the adapter picks the only one for an empty host
+        pass
+
+    async def commit_prepared(self, instance: dict) -> None:
+        pass
+
+    def invalidate_inventory(self) -> None:
+        pass
+
+    def minion_id(self, instance: dict) -> str:
+        return instance["prov_name"].split("_")[-1]
+
+
+class SyncAdapter(nacl.orchestrators.Orchestrator):
+    # drives an AsyncOrchestrator from the blocking commands in nacl.cli,
+    # everything that isn't a coroutine is passed straight through
+    def __init__(self, orch: AsyncOrchestrator) -> None:
+        self.orch = orch
+        self.connection_type = orch.connection_type
+        self.loop = asyncio.new_event_loop()
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        if name == "orch":
+            raise AttributeError(name)
+        return getattr(self.orch, name)
+
+    def run(self, name: str, *args, **kwargs):
+        with self.lock, nacl.timings.span(f"{type(self.orch).__name__}.{name}", "orchestrator"):
+            # cleanup closes the loop, a destroy phase is followed by create
+            if self.loop.is_closed():
+                self.loop = asyncio.new_event_loop()
+            return self.loop.run_until_complete(getattr(self.orch, name)(*args, **kwargs))
+
+    def orchestrate(self) -> dict[str, str]:
+        return self.run("orchestrate")
+
+    def cleanup(self) -> None:
+        try:
+            self.run("cleanup")
+        finally:
+            with self.lock:
+                self.loop.close()
+
+    def get_inventory(self) -> list[tuple[str]]:
+        return self.run("get_inventory")
+
+    def exec(self, name: str, cmd: str, output=None, timeout: Optional[float] = None) -> subprocess.CompletedProcess:
+        return self.run("exec", name, cmd, output, timeout)
+
+    def commit_prepared(self, instance: dict) -> None:
+        self.run("commit_prepared", instance)
+
+    def login(self, host: str) -> None:
+        if host == "":
+            inv = self.get_inventory()
+            if len(inv) > 1:
+                print("More than one host exists in scenarios, please specify with --host which one you wish to connect to")
+                return
+            host = inv[0][0]
+        self.orch.login(host)
+
+    def invalidate_inventory(self) -> None:
+        self.orch.invalidate_inventory()
+
+    def minion_id(self, instance: dict) -> str:
+        return self.orch.minion_id(instance)
+
+
+class AsyncDocker(nacl.orchestrators.DockerLayout, AsyncOrchestrator):
+    # the same containers as Docker, driven over the engine API socket so a
+    # single event loop can create and start all of them at once
+    def __init__(self, config: dict) -> None:
+        self.init_paths(config)
+        if self.shared_master:
+            raise ConfigException("shared_master is not supported together with async_api yet")
+        self._containers: Optional[dict[str, types.SimpleNamespace]] = None
+        self.api = nacl.docker_api.DockerAPI()
+
+    def invalidate_inventory(self) -> None:
+        self._containers = None
+
+    def login(self, host: str) -> None:
+        self.shell(host)
+
+    async def get_containers(self) -> dict[str, types.SimpleNamespace]:
+        if self._containers is None:
+            found = await self.api.request(
+                "GET",
+                "/containers/json",
+                {
+                    "all": "1",
+                    "filters": json.dumps({"label": ["app=nacl", f"formula={self.config['formula']}", f"scenario={self.config['scenario']}"]}),
+                },
+            )
+            self._containers = {
+                x["Names"][0].lstrip("/"): types.SimpleNamespace(
+                    id=x["Id"], name=x["Names"][0].lstrip("/"), status=x["State"], labels=x["Labels"]
+                )
+                for x in found
+            }
+        return self._containers
+
+    async def get_inventory(self) -> list[tuple[str]]:
+        return self.inventory_from(await self.get_containers(), nacl.state.StateStore().get(self.config))
+
+    async def exec(
+        self, name: str, cmd: str, output=None, timeout: Optional[float] = None
+    ) -> subprocess.CompletedProcess:
+        exec_id = (
+            await self.api.request(
+                "POST",
+                f"/containers/{name}/exec",
+                body={"AttachStdout": True, "AttachStderr": True, "Tty": False, "Cmd": shlex.split(cmd)},
+            )
+        )["Id"]
+        streams = {1: LineBuffer(output), 2: LineBuffer(output)}
+
+        async def read() -> None:
+            buffer = bytearray()
+            async for chunk in self.api.stream("POST", f"/exec/{exec_id}/start", {"Detach": False, "Tty": False}):
+                buffer += chunk
+                for stream, data in nacl.docker_api.demux(buffer):
+                    streams.get(stream, streams[1]).feed(data)
+
+        # a timeout closes the connection, the command itself keeps running
+        # in the container since docker can't stop an exec
+        try:
+            await asyncio.wait_for(read(), timeout)
+        except asyncio.TimeoutError:
+            raise OrchestrationTimeout(f"Timed out after {timeout}s running '{cmd}' in {name}")
+        stdout, stderr = streams[1].close(), streams[2].close()
+        inspect = {}
+
+        async def exited() -> bool:
+            inspect.update(await self.api.request("GET", f"/exec/{exec_id}/json"))
+            return not inspect["Running"]
+
+        await wait_for(exited, f"'{cmd}' in {name} to exit", 60, delay=0.05)
+        return subprocess.CompletedProcess(cmd, inspect["ExitCode"], stdout, stderr)
+
+    async def image_exists(self, name: str) -> bool:
+        try:
+            await self.api.request("GET", f"/images/{name}/json")
+        except nacl.docker_api.DockerAPIError as error:
+            if error.status == 404:
+                return False
+            raise
+        return True
+
+    async def commit_prepared(self, instance: dict) -> None:
+        if not self.config.get("image_cache", False):
+            return
+        repository, tag = self.prepared_image(instance).split(":")
+        # like Docker.commit_prepared, the minion's key is only dropped in a
+        # throwaway copy of the container
+        snapshot = (await self.api.request("POST", "/commit", {"container": instance["prov_name"]}))["Id"]
+        image_config = (await self.api.request("GET", f"/images/{snapshot}/json"))["Config"]
+        scratch = (
+            await self.api.request(
+                "POST",
+                "/containers/create",
+                body=nacl.docker_api.create_body(
+                    {"image": snapshot, "entrypoint": ["rm", "-rf"], "command": [nacl.orchestrators.MINION_PKI_DIR, "/etc/salt/minion_id"]}
+                ),
+            )
+        )["Id"]
+        try:
+            await self.api.request("POST", f"/containers/{scratch}/start")
+            await self.api.request("POST", f"/containers/{scratch}/wait")
+            await self.api.request(
+                "POST",
+                "/commit",
+                {
+                    "container": scratch,
+                    "repo": repository,
+                    "tag": tag,
+                    "changes": "\n".join(nacl.orchestrators.entrypoint_changes(image_config)),
+                },
+            )
+        finally:
+            await self.api.request("DELETE", f"/containers/{scratch}", {"force": "1"})
+            await self.api.request("DELETE", f"/images/{snapshot}")
+        print(f"==> Cached prepared image for {instance['prov_name'].split('_')[-1]}")
+
+    async def master_ready(self) -> bool:
+        try:
+            proc = await self.exec(self.master_name, "salt-run fileserver.dir_list", timeout=60)
+        except nacl.docker_api.DockerAPIError:
+            return False
+        return proc.returncode == 0 and b"ERROR" not in proc.stdout + proc.stderr
+
+    async def minions_ready(self, minions: list[str]) -> bool:
+        try:
+            accepted = json.loads((await self.exec(self.master_name, "salt-key list --out=json", timeout=60)).stdout)["minions"]
+        except (ValueError, KeyError, nacl.docker_api.DockerAPIError):
+            return False
+        waiting = [x for x in minions if x not in accepted]
+        if waiting != []:
+            print(f"==> Waiting for {', '.join(waiting)} to come up...")
+        return waiting == []
+
+    async def pull(self, image: str) -> None:
+        from docker.utils import parse_repository_tag
+
+        repository, tag = parse_repository_tag(image)
+        print(f"==> Pulling {image}")
+        data = b"".join([x async for x in self.api.stream("POST", "/images/create", params={"fromImage": repository, "tag": tag or "latest"})])
+        errors = nacl.docker_api.pull_errors(data)
+        if errors != []:
+            raise nacl.docker_api.DockerAPIError(500, f"pulling {image} failed: {errors[-1]}")
+
+    async def run_container(self, options: dict, net_id: str, alias: str) -> None:
+        # like containers.run, pull an image that isn't there yet and retry
+        try:
+            created = await self.api.request(
+                "POST", "/containers/create", {"name": options["name"]}, nacl.docker_api.create_body(options)
+            )
+        except nacl.docker_api.DockerAPIError as error:
+            if error.status != 404:
+                raise
+            await self.pull(options["image"])
+            created = await self.api.request(
+                "POST", "/containers/create", {"name": options["name"]}, nacl.docker_api.create_body(options)
+            )
+        await self.api.request(
+            "POST", f"/networks/{net_id}/connect", body={"Container": created["Id"], "EndpointConfig": {"Aliases": [alias]}}
+        )
+        await self.api.request("POST", f"/containers/{created['Id']}/start")
+
+    async def start_minion(self, instance: dict, containers: dict, net_id: str) -> tuple[Optional[str], Optional[str]]:
+        # the minion id to wait on and, for a new container, its starting state
+        short_name = instance["prov_name"].split("_")[-1]
+        if instance["prov_name"] in containers:
+            if containers[instance["prov_name"]].status == "running":
+                return None, None
+            await self.api.request("POST", f"/containers/{containers[instance['prov_name']].id}/start")
+            return self.minion_id(instance), None
+        options, minion_config = self.minion_options(instance)
+        state = nacl.state.CREATED
+        cached = self.prepared_image(instance) if self.config.get("image_cache", False) else None
+        if cached is not None and await self.image_exists(cached):
+            options["image"] = cached
+            print(f"==> Using cached prepared image for {short_name}")
+            state = nacl.state.PREPARED
+        with open(f"{self.scenario_dir}/{instance['prov_name']}_minion", "w") as f:
+            json.dump(minion_config, f)
+        await self.run_container(options, net_id, short_name)
+        return self.minion_id(instance), state
+
+    async def orchestrate(self) -> dict[str, str]:
+        if not os.path.exists(self.scenario_dir):
+            os.makedirs(self.scenario_dir)
+        nets = await self.api.request("GET", "/networks", {"filters": json.dumps({"name": [self.network_name]})})
+        nets = [x for x in nets if x["Name"] == self.network_name]
+        if nets == []:
+            net_id = (await self.api.request("POST", "/networks/create", body={"Name": self.network_name}))["Id"]
+        else:
+            net_id = nets[0]["Id"]
+        containers = await self.get_containers()
+        timeout = self.config.get("ready_timeout", 300)
+        master_config = self.master_config()
+        current = None
+        if self.master_name in containers and os.path.exists(f"{self.master_dir}/master"):
+            with open(f"{self.master_dir}/master", "r") as f:
+                current = json.load(f)
+        with open(f"{self.master_dir}/master", "w") as f:
+            json.dump(master_config, f)
+        # every path that (re)starts the master waits on its file server
+        new_master = True
+        if self.master_name not in containers:
+            master = self.run_container(self.master_options(), net_id, "master")
+        elif current != master_config:
+            master = self.api.request("POST", f"/containers/{containers[self.master_name].id}/restart")
+        elif containers[self.master_name].status != "running":
+            master = self.api.request("POST", f"/containers/{containers[self.master_name].id}/start")
+        else:
+            master = asyncio.sleep(0)
+            new_master = False
+        # master and minions are created together, the minions retry the
+        # master on their own until it is up
+        _, minions = await asyncio.gather(
+            master, asyncio.gather(*[self.start_minion(x, containers, net_id) for x in self.config["instances"]])
+        )
+        started = [x for x, _ in minions if x is not None]
+        if new_master:
+            await wait_for(self.master_ready, "the salt master file server", timeout)
+        if started != []:
+            await wait_for(lambda: self.minions_ready(started), "minion keys to be accepted", timeout)
+        self.invalidate_inventory()
+        return {
+            x["prov_name"].split("_")[-1]: state
+            for x, (_, state) in zip(self.config["instances"], minions)
+            if state is not None
+        }
+
+    async def cleanup(self) -> None:
+        async def remove(cont) -> None:
+            print(f"==> Removing instance {cont.name.split('_')[-1]}")
+            await self.api.request("DELETE", f"/containers/{cont.id}", {"force": "1"})
+
+        await asyncio.gather(*[remove(x) for x in (await self.get_containers()).values()])
+        try:
+            await self.api.request("DELETE", f"/networks/{self.network_name}")
+        except nacl.docker_api.DockerAPIError as error:
+            if error.status != 404:
+                raise
+        if os.path.exists(self.scenario_dir):
+            shutil.rmtree(self.scenario_dir)
+        nacl.state.StateStore().remove_scenario(self.config)
+        self.invalidate_inventory()
+
+
+class AsyncVagrant(nacl.orchestrators.VagrantLayout, AsyncOrchestrator):
+    def __init__(self, config: dict) -> None:
+        self.init_paths(config)
+
+    def login(self, host: str) -> None:
+        self.shell(host)
+
+    async def run_vagrant(self, *args: str, output=None) -> tuple[int, bytes]:
+        with nacl.timings.span("vagrant", "subprocess", cmd=" ".join(args)):
+            proc = await asyncio.create_subprocess_exec(
+                "vagrant", *args, cwd=self.scenario_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+            )
+            assert proc.stdout is not None
+            buffer = LineBuffer(output)
+            # fixed size reads, a box download redraws its progress with \r
+            # and no newline for longer than readline() will buffer
+            while chunk := await proc.stdout.read(65536):
+                buffer.feed(chunk)
+            return await proc.wait(), buffer.close()
+
+    async def machine_states(self) -> dict[str, str]:
+        if self._machine_states is None:
+            if not os.path.exists(f"{self.scenario_dir}/Vagrantfile"):
+                self._machine_states = {x["prov_name"]: "not_created" for x in self.config["instances"]}
+            else:
+                states = self.index_states()
+                if states is None:
+                    _, out = await self.run_vagrant("status", "--machine-readable")
+                    # timestamp,target,type,data
+                    states = {
+                        x.split(",")[1]: x.split(",")[3]
+                        for x in out.decode(errors="replace").splitlines()
+                        if len(x.split(",")) > 3 and x.split(",")[2] == "state"
+                    }
+                self._machine_states = states
+        return self._machine_states
+
+    async def get_inventory(self) -> list[tuple[str]]:
+        return self.inventory_from(await self.machine_states(), nacl.state.StateStore().get(self.config))
+
+    async def exec(
+        self, name: str, cmd: str, output=None, timeout: Optional[float] = None
+    ) -> subprocess.CompletedProcess:
+        try:
+            returncode, out = await asyncio.wait_for(self.run_vagrant("ssh", name, "-c", cmd, output=output), timeout)
+        except asyncio.TimeoutError:
+            raise OrchestrationTimeout(f"Timed out after {timeout}s running '{cmd}' in {name}")
+        return subprocess.CompletedProcess(cmd, returncode, out, b"")
+
+    async def orchestrate(self) -> dict[str, str]:
+        before = await self.machine_states()
+        self.write_vagrantfile()
+        limit = asyncio.Semaphore(max(1, self.config["provider"].get("up_parallelism", len(self.config["instances"]))))
+
+        async def up(name: str) -> None:
+            async with limit:
+                returncode, _ = await self.run_vagrant(
+                    "up", name, output=lambda line: print(f"    {name.split('_')[-1]}: {line.decode(errors='replace').rstrip()}")
+                )
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, f"vagrant up {name}")
+
+        await asyncio.gather(*[up(x["prov_name"]) for x in self.config["instances"]])
+        if self.config["salt_exec_mode"] == "salt-ssh":
+            _, ssh_config = await self.run_vagrant("ssh-config")
+            self.write_salt_ssh_files(ssh_config.decode())
+        self.invalidate_inventory()
+        return {
+            x["prov_name"].split("_")[-1]: nacl.state.CREATED
+            for x in self.config["instances"]
+            if before.get(x["prov_name"], "not_created") == "not_created"
+        }
+
+    async def cleanup(self) -> None:
+        if os.path.exists(f"{self.scenario_dir}/Vagrantfile"):
+            await self.run_vagrant("destroy", "-f", output=lambda line: print(line.decode(errors="replace").rstrip()))
+        if os.path.exists(self.scenario_dir):
+            shutil.rmtree(self.scenario_dir)
+        nacl.state.StateStore().remove_scenario(self.config)
+        self.invalidate_inventory()
@@ -1,15 +1,22 @@
 import argparse
 import os
-import re
-import subprocess
 import sys
+import time
 import shutil
-import pathlib
 from typing import Tuple
 
+import nacl.apply
+import nacl.async_orchestrators
 import nacl.config
 import nacl.exceptions
+import nacl.fingerprint
+import nacl.lint
 import nacl.orchestrators
+import nacl.runner
+import nacl.sls
+import nacl.state
+import nacl.sync
+import nacl.timings
 import nacl.utils
 import nacl.verifiers
 
@@ -17,6 +24,9 @@ import nacl.verifiers
 def get_orchestrator(orch_name, config) -> nacl.orchestrators.Orchestrator:
     proper_name = list(orch_name)
     proper_name[0] = proper_name[0].upper()
+    if config.get("async_api", False):
+        orch = getattr(nacl.async_orchestrators, f"Async{''.join(proper_name)}")(config)
+        return nacl.async_orchestrators.SyncAdapter(orch)
     return getattr(nacl.orchestrators, "".join(proper_name))(config)
 
 
@@ -32,93 +42,107 @@ def create(
     config: dict,
     orch: nacl.orchestrators.Orchestrator,
 ) -> None:
-    nacl.utils.copy_srv_dir(config["running_tmp_dir"], config["formula"], cur_dir)
-    if not "nacl.yml" in os.listdir():
-        os.chdir(f"nacl/{config['scenario']}")
-    orch.orchestrate()
+    sync(args, config, cur_dir)
+    created = orch.orchestrate()
+    store = nacl.state.StateStore()
+    known = store.get(config)
+    for instance in config["instances"]:
+        name = instance["prov_name"].split("_")[-1]
+        if name in created:
+            # a fresh machine, whatever was recorded for its name before no
+            # longer holds
+            if name in known:
+                store.remove(config, name)
+            store.set_state(config, instance, created[name])
+        elif name not in known:
+            store.set_state(config, instance, nacl.state.CREATED)
 
 def prepare(
     args: argparse.Namespace,
     cur_dir: str,
     config: dict,
     orch: nacl.orchestrators.Orchestrator,
-) -> dict[str, str]:
-    scenario_dir = f"{config['running_tmp_dir']}/{config['provider']['name']}/{config['formula']}/{config['scenario']}/nacl/"
+) -> dict[str, nacl.apply.ApplyResult]:
     current_inv = [x for x in orch.get_inventory() if x[1] != "Not created"]
     if current_inv == []:
         create(args, cur_dir, config, orch)
-        nacl.utils.copy_srv_dir(config["running_tmp_dir"], config["formula"], cur_dir)
-    if not "nacl.yml" in os.listdir():
-        os.chdir(f"nacl/{config['scenario']}")
-    cwd = os.getcwd()
-    if current_inv == []:
-        orch.orchestrate()
-    instance_output: dict[str, str] = {}
-    prepared_instances = []
-    for item in os.listdir(f"{config['running_tmp_dir']}/{config['provider']['name']}/{config['formula']}/{config['scenario']}"):
-        if 'prepared' in item:
-            prepared_instances.append(item.split(".")[0])
+    store = nacl.state.StateStore()
+    known = store.get(config)
+    if not os.path.exists(f"{cur_dir}/nacl/{config['scenario']}/prepare.sls"):
+        return {}
+    to_prepare = []
     for instance in config["instances"]:
-        if instance['prov_name'] in prepared_instances:
+        if known.get(instance["prov_name"].split("_")[-1], {}).get("state") in (nacl.state.PREPARED, nacl.state.CONVERGED):
             print(f"==> instance {instance['prov_name'].split('_')[-1]} already prepared")
-        elif not os.path.exists(f"{cwd}/prepare.sls"):
-            pass
         else:
             print(f"==> Preparing instances on {instance['prov_name'].split('_')[-1]}")
-            if config["salt_exec_mode"] == "salt-ssh":
-                proc = subprocess.run(
-                    f'salt-ssh {instance["prov_name"]} --saltfile={scenario_dir}Saltfile -i state.sls prepare',
-                    shell=True,
-                    capture_output=True,
-                )
-                output = proc.stdout.decode()
-                print(output)
-                instance_output[instance["prov_name"].split("_")[-1]] = output
-                if proc.returncode == 0:
-                    prepared = pathlib.Path(f"{config['running_tmp_dir']}/{config['provider']['name']}/{config['formula']}/{config['scenario']}/{instance['prov_name']}.prepared")
-                    prepared.touch()
-            elif config["salt_exec_mode"] == "salt-master":
-                proc = orch.exec(f"nacl_{config['formula']}_{config['scenario']}_master", f"salt '{instance['prov_name'].split('_')[-1]}' state.apply {config['formula']}/nacl/{config['scenario']}/prepare")
-                output = proc.stdout.decode()
-                print(output)
-                if proc.returncode == 0:
-                    prepared = pathlib.Path(f"{config['running_tmp_dir']}/{config['provider']['name']}/{config['formula']}/{config['scenario']}/{instance['prov_name']}.prepared")
-                    prepared.touch()
+            to_prepare.append(instance)
+    if config["salt_exec_mode"] == "salt-ssh":
+        state = "prepare"
+    else:
+        state = f"{config['formula']}/nacl/{config['scenario']}/prepare"
+    results = nacl.apply.apply_states(config, orch, to_prepare, state, "prepare")
+    for instance in to_prepare:
+        if results[instance["prov_name"].split("_")[-1]].succeeded:
+            store.set_state(config, instance, nacl.state.PREPARED)
+            orch.commit_prepared(instance)
+    return results
+
 
 def converge(
     args: argparse.Namespace,
     cur_dir: str,
     config: dict,
     orch: nacl.orchestrators.Orchestrator,
-) -> dict[str, str]:
-    scenario_dir = f"{config['running_tmp_dir']}/{config['provider']['name']}/{config['formula']}/{config['scenario']}/nacl/"
-    if orch.get_inventory() == []:
-        nacl.utils.copy_srv_dir(config["running_tmp_dir"], config["formula"], cur_dir)
-    if not "nacl.yml" in os.listdir():
-        os.chdir(f"nacl/{config['scenario']}")
-    if orch.get_inventory() == []:
-        orch.orchestrate()
+) -> dict[str, nacl.apply.ApplyResult]:
+    if all(x[1] == "Not created" for x in orch.get_inventory()):
+        create(args, cur_dir, config, orch)
     prepare(args, cur_dir, config, orch)
-    instance_output: dict[str, str] = {}
-    for instance in config["instances"]:
-        if instance.get("converge", True):
-            print(f"==> Applying state on {instance['prov_name'].split('_')[-1]}")
-            if config["salt_exec_mode"] == "salt-ssh":
-                proc = subprocess.run(
-                    f'salt-ssh {instance["prov_name"]} --saltfile={scenario_dir}Saltfile -i state.sls {config["formula"]}',
-                    shell=True,
-                    capture_output=True,
-                )
-                output = proc.stdout.decode() + proc.stderr.decode()
-                print(output)
-                instance_output[instance["prov_name"].split("_")[-1]] = output
-            if config["salt_exec_mode"] == "salt-master":
-                proc = orch.exec(f"nacl_{config['formula']}_{config['scenario']}_master", f"salt {instance['prov_name'].split('_')[-1]} state.apply {config['formula']}")
-                output = proc.stdout.decode()
-                print(output)
-                instance_output[instance["prov_name"].split("_")[-1]] = output
- 
-    return instance_output
+    store = nacl.state.StateStore()
+    known = store.get(config)
+    index = nacl.sls.SlsIndex(config)
+    fingerprints = {}
+    instances = []
+    targets: dict[str, list[dict]] = {}
+    for instance in [x for x in config["instances"] if x.get("converge", True)]:
+        name = instance["prov_name"].split("_")[-1]
+        fingerprints[name] = nacl.fingerprint.apply_fingerprint(config, instance)
+        row = known.get(name, {})
+        if (
+            getattr(args, "if_changed", False)
+            and row.get("state") == nacl.state.CONVERGED
+            and row.get("formula_hash") == fingerprints[name]
+        ):
+            print(f"==> {name} is up to date, skipping")
+            continue
+        state = config["formula"]
+        if getattr(args, "changed_only", False) and row.get("state") == nacl.state.CONVERGED:
+            states = index.changed_states(instance, config["formula"])
+            if states == []:
+                print(f"==> Nothing {name} applies depends on the changed files, skipping")
+                store.set_state(config, instance, nacl.state.CONVERGED, fingerprints[name])
+                index.record_applied(instance)
+                continue
+            if states is not None:
+                state = ",".join(states)
+        print(f"==> Applying {state} on {name}")
+        instances.append(instance)
+        targets.setdefault(state, []).append(instance)
+    results = {}
+    for i, (state, group) in enumerate(targets.items()):
+        phase = "converge" if len(targets) == 1 else f"converge-{i}"
+        results.update(nacl.apply.apply_states(config, orch, group, state, phase))
+    for instance in instances:
+        name = instance["prov_name"].split("_")[-1]
+        if results[name].succeeded:
+            store.set_state(config, instance, nacl.state.CONVERGED, fingerprints[name])
+            index.record_applied(instance)
+        elif known.get(name, {}).get("state") == nacl.state.CONVERGED:
+            # the instance now holds part of a formula nothing has recorded,
+            # it's only known to be prepared until a converge succeeds
+            store.set_state(config, instance, nacl.state.PREPARED)
+    index.save()
+    return {x["prov_name"].split("_")[-1]: results[x["prov_name"].split("_")[-1]] for x in instances}
 
 
 def idempotence(
@@ -128,24 +152,40 @@ def idempotence(
     orch: nacl.orchestrators.Orchestrator,
 ) -> None:
     print("> Running idempotence check")
-    instance_output = converge(args, cur_dir, config, orch)
+    if config.get("idempotence_mode", "full") == "dry-run":
+        # a test=True apply reports what would still change without
+        # touching the instances or going through prepare again
+        instances = [x for x in config["instances"] if x.get("converge", True)]
+        instance_output = nacl.apply.apply_states(
+            config, orch, instances, config["formula"], "idempotence", test=True
+        )
+    else:
+        instance_output = converge(args, cur_dir, config, orch)
+    failed = False
     for k, v in instance_output.items():
-        if re.findall(r"\(changed=\d*\)", v) != []:
-            print(f"==> {k} Failed idempotance check", file=sys.stderr)
-            orch.cleanup()
-            sys.exit(1)
+        if v.result.pending != []:
+            print(f"==> {k} Failed idempotance check, states still changing:", file=sys.stderr)
+            for state in v.result.pending:
+                print(f"    {state.id} ({state.function}) in {state.sls}", file=sys.stderr)
+            failed = True
+        elif not v.succeeded:
+            print(f"==> {k} Failed idempotance check, the state run failed", file=sys.stderr)
+            failed = True
+    if failed:
+        orch.cleanup()
+        sys.exit(1)
 
 
 def destroy(
     args: argparse.Namespace, config: dict, orch: nacl.orchestrators.Orchestrator
 ) -> None:
-    if not "nacl.yml" in os.listdir():
-        os.chdir(f"nacl/{config['scenario']}")
-    if os.path.exists(f"{config['running_tmp_dir']}/formulas/{config['formula']}"):
+    # the formula copy is shared by every scenario of a test run, so leave it
+    # to whoever synced it up front
+    if not getattr(args, "formula_synced", False) and os.path.exists(f"{config['running_tmp_dir']}/formulas/{config['formula']}"):
         shutil.rmtree(f"{config['running_tmp_dir']}/formulas/{config['formula']}")
     orch.cleanup()
-    if os.path.exists(f"{config['running_tmp_dir']}/{config['provider']['name']}/{config['formula']}"):
-        shutil.rmtree(f"{config['running_tmp_dir']}/{config['provider']['name']}/{config['formula']}")
+    if os.path.exists(f"{config['running_tmp_dir']}/{config['provider']['name']}/{config['formula']}/{config['scenario']}"):
+        shutil.rmtree(f"{config['running_tmp_dir']}/{config['provider']['name']}/{config['formula']}/{config['scenario']}")
 
 
 
@@ -153,11 +193,76 @@ def verify(
     args: argparse.Namespace, config: dict, orch: nacl.orchestrators.Orchestrator
 ) -> None:
     veri = get_verifier(config, orch)
-    veri.run()
+    result = veri.run(not getattr(args, "no_cache", False))
+    for run in result.failed:
+        print(f"[x] Verify failed on {run.host} ({run.tests}), see {run.log_file}", file=sys.stderr)
+    if result.junit_file:
+        print(f"==> Test report written to {result.junit_file}")
+    if not result.passed:
+        sys.exit(1)
+
 
+def sync(args: argparse.Namespace, config: dict, cur_dir: str) -> nacl.sync.SyncResult:
+    if getattr(args, "formula_synced", False):
+        return nacl.sync.SyncResult()
+    result = nacl.utils.copy_srv_dir(
+        config["running_tmp_dir"],
+        config["formula"],
+        cur_dir,
+        config.get("sync_mode", "reflink"),
+    )
+    if result:
+        print(f"==> Synced formula {config['formula']} ({len(result.added)} added, {len(result.changed)} changed, {len(result.removed)} removed)")
+    return result
 
-def sync(args: argparse.Namespace, config: dict, cur_dir: str) -> None:
-    nacl.utils.copy_srv_dir(config["running_tmp_dir"], config["formula"], cur_dir)
+
+def snapshot_tree(cur_dir: str, patterns: list[str]) -> dict[str, tuple[int, int]]:
+    return {
+        k: (v.st_size, v.st_mtime_ns)
+        for k, v in nacl.sync.scan_tree(cur_dir, patterns).items()
+    }
+
+
+def watch(
+    args: argparse.Namespace,
+    cur_dir: str,
+    config: dict,
+    orch: nacl.orchestrators.Orchestrator,
+) -> None:
+    create(args, cur_dir, config, orch)
+    # only instances whose apply fingerprint moved get the formula again
+    args.if_changed = True
+    converge(args, cur_dir, config, orch)
+    patterns = nacl.sync.load_ignore(cur_dir)
+    snapshot = snapshot_tree(cur_dir, patterns)
+    print(f"==> Watching {cur_dir} for changes, press ctrl-c to stop")
+    try:
+        while True:
+            time.sleep(args.interval)
+            current = snapshot_tree(cur_dir, patterns)
+            if current == snapshot:
+                continue
+            # editors save in bursts, wait for the tree to settle first
+            while True:
+                time.sleep(args.debounce)
+                settled = snapshot_tree(cur_dir, patterns)
+                if settled == current:
+                    break
+                current = settled
+            snapshot = current
+            result = sync(args, config, cur_dir)
+            if not result:
+                continue
+            for rel_path in result.updated + result.removed:
+                print(f"    {rel_path}")
+            started = time.monotonic()
+            results = converge(args, cur_dir, config, orch)
+            failed = [k for k, v in results.items() if not v.succeeded]
+            if failed != []:
+                print(f"[x] Converge failed on {', '.join(failed)}", file=sys.stderr)
+            print(f"==> Applied on {len(results)} instances in {time.monotonic() - started:.1f}s, watching for changes")
+    except KeyboardInterrupt:
+        print("\n==> Stopped watching")
 
 
 def login(
@@ -165,17 +270,33 @@ def login(
 ) -> None:
     orch.login(args.host)
 
-def list_command(args: argparse.Namespace, config: dict, orch: nacl.orchestrators.Orchestrator) -> None:
-    print("Name","\t","State")
-    for instance in orch.get_inventory():
-        print(instance[0].split("_")[-1],instance[1])
+def list_command(args: argparse.Namespace, config: dict) -> None:
+    store = nacl.state.StateStore()
+    # only --refresh pays for a backend client, everything else is answered
+    # from the state store
+    if args.refresh:
+        orch = get_orchestrator(config["provider"]["name"], config)
+        store.reconcile(config, orch.get_inventory())
+    known = store.get(config)
+    print("Name","\t","State","\t","Base","\t","Updated")
+    for instance in config["instances"]:
+        name = instance["prov_name"].split("_")[-1]
+        row = known.get(name, {})
+        updated = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(row["updated_at"])) if row else "-"
+        print(name, "\t", row.get("state", nacl.state.NOT_CREATED), "\t", row.get("base") or "-", "\t", updated)
 
-def lint() -> None:
+def lint(cur_dir: str) -> bool:
     print("> Linting")
-    proc = subprocess.run("salt-lint */*", shell=True)
-    if proc.returncode != 0:
+    result = nacl.lint.lint_tree(cur_dir)
+    print(f"==> Linted {len(result.files)} files, {len(result.cached)} unchanged since the last run")
+    for rel_path, matches in sorted(result.matches.items()):
+        for match in matches:
+            print(nacl.lint.format_match(match), file=sys.stderr)
+    for error in result.errors:
+        print(f"[x] {error}", file=sys.stderr)
+    if not result.passed:
         print("[x] Linting failed", file=sys.stderr)
-        sys.exit(1)
+    return result.passed
 
 
 def init(args: argparse.Namespace) -> None:
@@ -192,40 +313,92 @@ def init(args: argparse.Namespace) -> None:
         sys.exit(1)
 
 
-def test(args: argparse.Namespace, cur_dir: str) -> None:
-    for scenario in os.listdir("nacl/"):
-        if args.all or args.scenario == scenario:
-            config = nacl.config.parse_config(nacl.config.get_config(scenario))
-            if "phases" in config.keys():
-                phases = config["phases"]
-            else:
-                phases = nacl.config.PHASES
-            orch = get_orchestrator(config["provider"]["name"], config)
-            print(f"> Starting Test of scenario {scenario}")
-            for phase in phases:
-                if phase == "create":
-                    create(args, cur_dir, config, orch)
-                elif phase == "prepare":
-                    prepare(ars, cur_dir, config, orch)
-                elif phase == "converge":
-                    for k, v in converge(args, cur_dir, config, orch).items():
-                        if re.findall(r"Failed:\s+0", v) == []:
-                            orch.cleanup()
-                            sys.exit(1)
-                elif phase == "lint":
-                    os.chdir(cur_dir)
-                    lint()
-                elif phase == "destroy":
-                    destroy(args, config, orch)
-                elif phase == "idempotence":
-                    os.chdir(cur_dir)
-                    idempotence(args, cur_dir, config, orch)
-                elif phase == "verify":
-                    verify(args, config, orch)
-                else:
-                    print(f"[x] Unknown testing phase {phase}", file=sys.stderr)
-                    orch.cleanup()
-                    sys.exit(1)
+def test_scenario(args: argparse.Namespace, cur_dir: str, scenario: str) -> None:
+    config = nacl.config.parse_config(nacl.config.get_config(scenario))
+    if "phases" in config.keys():
+        phases = config["phases"]
+    else:
+        phases = nacl.config.PHASES
+    orch = get_orchestrator(config["provider"]["name"], config)
+    print(f"> Starting Test of scenario {scenario}")
+    for phase in phases:
+        with nacl.timings.span(phase, scenario=scenario):
+            run_phase(args, cur_dir, config, orch, phase)
+
+
+def run_phase(
+    args: argparse.Namespace,
+    cur_dir: str,
+    config: dict,
+    orch: nacl.orchestrators.Orchestrator,
+    phase: str,
+) -> None:
+    if phase == "create":
+        create(args, cur_dir, config, orch)
+    elif phase == "prepare":
+        prepare(args, cur_dir, config, orch)
+    elif phase == "converge":
+        for k, v in converge(args, cur_dir, config, orch).items():
+            if not v.succeeded:
+                print(f"[x] Converge failed on {k}", file=sys.stderr)
+                orch.cleanup()
+                sys.exit(1)
+    elif phase == "lint":
+        # a multi scenario test run lints the tree once up front
+        passed = args.lint_passed if getattr(args, "lint_passed", None) is not None else lint(cur_dir)
+        if not passed:
+            sys.exit(1)
+    elif phase == "destroy":
+        destroy(args, config, orch)
+    elif phase == "idempotence":
+        idempotence(args, cur_dir, config, orch)
+    elif phase == "verify":
+        verify(args, config, orch)
+    else:
+        print(f"[x] Unknown testing phase {phase}", file=sys.stderr)
+        orch.cleanup()
+        sys.exit(1)
+
+
+def test(args: argparse.Namespace, cur_dir: str) -> bool:
+    scenarios = [
+        x for x in sorted(os.listdir(f"{cur_dir}/nacl/"))
+        if args.all or args.scenario == x
+    ]
+    if scenarios == []:
+        print(f"[x] No scenario {args.scenario} found", file=sys.stderr)
+        return False
+    if args.timings is not None:
+        nacl.timings.TRACER.enabled = True
+    # every scenario reads the same formula copy, sync it once instead of
+    # letting each pipeline replace it under the others' feet
+    with nacl.timings.span("sync"):
+        raw_configs = [nacl.config.get_config(x) for x in scenarios]
+        # scenarios of one formula share its copy, the first one's sync_mode wins
+        formulas: dict[str, dict] = {}
+        for raw_config in raw_configs:
+            formulas.setdefault(raw_config["formula"], raw_config)
+        for raw_config in formulas.values():
+            sync(args, {**raw_config, "running_tmp_dir": nacl.config.TMP_DIR}, cur_dir)
+    args.formula_synced = True
+    # a shared salt master is set up for all of the formula's scenarios
+    # before any of them runs, so no scenario reconfigures it under another
+    shared = {x["formula"]: x for x in raw_configs if x.get("shared_master", False) and x["provider"]["name"] == "docker"}
+    for raw_config in shared.values():
+        with nacl.timings.span("shared master", formula=raw_config["formula"]):
+            config = nacl.config.parse_config(dict(raw_config))
+            get_orchestrator(config["provider"]["name"], config).start_shared_master()
+    if any("lint" in x.get("phases", nacl.config.PHASES) for x in raw_configs):
+        with nacl.timings.span("lint"):
+            args.lint_passed = lint(cur_dir)
+    results = nacl.runner.run_scenarios(
+        test_scenario, args, cur_dir, scenarios, args.parallelsim, args.timings is not None
+    )
+    nacl.runner.print_summary(results)
+    if args.timings is not None:
+        nacl.timings.TRACER.write(args.timings)
+        nacl.timings.print_summary(args.timings)
+    return all(x.passed for x in results)
 
 
 def parse_args() -> Tuple[argparse.Namespace, argparse.ArgumentParser]:
@@ -241,6 +414,18 @@ def parse_args() -> Tuple[argparse.Namespace, argparse.ArgumentParser]:
         help="scenario to use for converge. Default is default",
         default="default",
     )
+    converge_parser.add_argument(
+        "--if-changed",
+        action="store_true",
+        default=False,
+        help="Skip instances whose formula, pillar, extra file roots and grains are unchanged since their last successful converge",
+    )
+    converge_parser.add_argument(
+        "--changed-only",
+        action="store_true",
+        default=False,
+        help="Only apply the sls files that changed since the last successful converge and the ones that depend on them",
+    )
     # login parser
     login_parser = subparsers.add_parser("login")
     login_parser.add_argument("--login", help=argparse.SUPPRESS)
@@ -256,6 +441,27 @@ def parse_args() -> Tuple[argparse.Namespace, argparse.ArgumentParser]:
         help="Scenario to load config of. Default is default",
         default="default",
     )
+    # watch command
+    watch_parser = subparsers.add_parser("watch")
+    watch_parser.add_argument("--watch", help=argparse.SUPPRESS)
+    watch_parser.add_argument(
+        "-s",
+        "--scenario",
+        help="Scenario to keep converged. Default is default",
+        default="default",
+    )
+    watch_parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.5,
+        help="Seconds between checks of the formula directory",
+    )
+    watch_parser.add_argument(
+        "--debounce",
+        type=float,
+        default=0.3,
+        help="Seconds the formula directory has to stay unchanged before it is synced",
+    )
     # lint command
     lint_parser = subparsers.add_parser("lint")
     lint_parser.add_argument("--lint", help=argparse.SUPPRESS)
@@ -268,10 +474,17 @@ def parse_args() -> Tuple[argparse.Namespace, argparse.ArgumentParser]:
         default="default",
     )
     test_parser.add_argument("--test", help=argparse.SUPPRESS)
+    test_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="Run every verify test even if it already passed against the same converged instance",
+    )
     test_parser.add_argument(
         "-p",
         "--parallelsim",
         default=1,
+        type=int,
         help="How many scenarios can be run at once. This defaults to 1",
     )
     test_parser.add_argument(
@@ -280,6 +493,13 @@ def parse_args() -> Tuple[argparse.Namespace, argparse.ArgumentParser]:
         default=True,
         help="Cleanup resources created. By default the is True",
     )
+    test_parser.add_argument(
+        "--timings",
+        nargs="?",
+        const=f"{nacl.config.TMP_DIR}timings/{os.path.basename(os.getcwd())}.json",
+        default=None,
+        help="Write a Chrome trace of phase, orchestrator and subprocess timings to this path and print a summary",
+    )
     test_parser.add_argument(
         "-a",
         "--all",
@@ -317,6 +537,12 @@ def parse_args() -> Tuple[argparse.Namespace, argparse.ArgumentParser]:
         help="Scenario to verify. Default is default",
         default="default",
     )
+    verify_parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        default=False,
+        help="Run every test even if it already passed against the same converged instance",
+    )
     list_parser = subparsers.add_parser("list")
     list_parser.add_argument("--list", help=argparse.SUPPRESS)
     list_parser.add_argument(
@@ -324,6 +550,12 @@ def parse_args() -> Tuple[argparse.Namespace, argparse.ArgumentParser]:
         help="scenario to use for converge. Default is default",
         default="default",
     )
+    list_parser.add_argument(
+        "--refresh",
+        action="store_true",
+        default=False,
+        help="Reconcile the recorded state with the provider before listing",
+    )
 
     # init
     init_parser = subparsers.add_parser("init")
@@ -371,27 +603,26 @@ def run() -> None:
             init(args)
         else:
             if "lint" in args:
-                lint()
+                if not lint(cur_dir):
+                    sys.exit(1)
                 sys.exit(0)
             elif "test" in args:
-                test(args, cur_dir)
-                sys.exit(0)
+                sys.exit(0 if test(args, cur_dir) else 1)
             elif "scenario" not in args:
                 parser.print_help()
                 sys.exit(0)
             else:
                 config = nacl.config.parse_config(nacl.config.get_config(args.scenario))
-                orch = get_orchestrator(config["provider"]["name"], config)
+            if "list" in args:
+                list_command(args, config)
+                sys.exit(0)
+            orch = get_orchestrator(config["provider"]["name"], config)
             if "destroy" in args:
                 destroy(args, config, orch)
-            elif "list" in args:
-                list_command(args, config, orch)
             elif "create" in args:
                 create(args, cur_dir, config, orch)
             elif "sync" in args:
-                nacl.utils.copy_srv_dir(
-                    config["running_tmp_dir"], config["formula"], cur_dir
-                )
+                sync(args, config, cur_dir)
             elif "converge" in args:
                 create(args, cur_dir, config, orch)
                 converge(args, cur_dir, config, orch)
@@ -399,6 +630,8 @@ def run() -> None:
                 prepare(args, cur_dir, config, orch)
             elif "login" in args:
                 login(args, config, orch)
+            elif "watch" in args:
+                watch(args, cur_dir, config, orch)
             elif "verify" in args:
                 verify(args, config, orch)
             else:
@@ -407,6 +640,7 @@ def run() -> None:
         nacl.exceptions.ConfigFileNotFound,
         nacl.exceptions.ScenarioExists,
         nacl.exceptions.ConfigException,
+        nacl.exceptions.OrchestrationTimeout,
     ) as error:
         print("[x]", error, file=sys.stderr)
         sys.exit(1)
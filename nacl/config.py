@@ -3,6 +3,7 @@ import os
 import yaml
 
 import nacl.orchestrators
+import nacl.sync
 from nacl.exceptions import ConfigException, ConfigFileNotFound
 
 TMP_DIR = f'{os.getenv("HOME")}/.nacl/'
@@ -20,22 +21,43 @@ SCHEMA = {
     "extra_file_roots": {"required": False, "type": list},
     "master_config": {"required": True, "type": dict},
     "salt_exec_mode": {"required": True, "type": str, "options": ["salt-ssh", "salt-master"]},
+    "apply_parallelism": {"required": False, "type": int},
+    "async_api": {"required": False, "type": bool},
+    "batch_size": {"required": False, "type": int},
+    "idempotence_mode": {"required": False, "type": str, "options": ["full", "dry-run"]},
+    "image_cache": {"required": False, "type": bool},
+    "ready_timeout": {"required": False, "type": int},
+    "shared_master": {"required": False, "type": bool},
+    "sync_mode": {"required": False, "type": str, "options": nacl.sync.LINK_MODES},
+    "verify_parallelism": {"required": False, "type": int},
 }
 
+PROVIDER_SCHEMA = {
+    "name": {"required": True, "type": str},
+    "up_parallelism": {"required": False, "type": int, "min": 1},
+}
 
-# bad validator that is not generic but whatever. Brain no worky today.
-def validate_config(config: dict, schema=SCHEMA) -> None:
+
+def validate_keys(config: dict, schema: dict, prefix: str = "") -> None:
     for k, v in schema.items():
         if v["required"] and k not in config.keys() and 'enabled':
-            raise ConfigException(f"Missing required key {k}")
+            raise ConfigException(f"Missing required key {prefix}{k}")
         elif k in config.keys() and v["type"] != type(config[k]):
             raise ConfigException(
-                f"Incorrect type for {k} \"{type(config[k])}\" should be {v['type']}"
+                f"Incorrect type for {prefix}{k} \"{type(config[k])}\" should be {v['type']}"
             )
-        elif "options" in v and config[k] not in v["options"]:
+        elif "options" in v and k in config.keys() and config[k] not in v["options"]:
             raise ConfigException(
-                f"Option provided for {k} not allowed. Allowable selections are: {v['options']}"
+                f"Option provided for {prefix}{k} not allowed. Allowable selections are: {v['options']}"
             )
+        elif "min" in v and k in config.keys() and config[k] < v["min"]:
+            raise ConfigException(f"{prefix}{k} must be at least {v['min']}")
+
+
+# bad validator that is not generic but whatever. Brain no worky today.
+def validate_config(config: dict, schema=SCHEMA) -> None:
+    validate_keys(config, schema)
+    validate_keys(config["provider"], PROVIDER_SCHEMA, "provider.")
     prov_name = list(config["provider"]["name"])
     prov_name[0] = prov_name[0].upper()
     instance_schema = getattr(nacl.orchestrators, "".join(prov_name)).__conf_schema__
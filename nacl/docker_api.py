@@ -0,0 +1,159 @@
+import asyncio
+import json
+import os
+import urllib.parse
+from typing import AsyncIterator, Optional
+
+# the oldest engine API with everything nacl uses, docker 20.10 and later
+API_VERSION = "1.41"
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+def socket_path() -> str:
+    host = os.getenv("DOCKER_HOST", "unix:///var/run/docker.sock")
+    if not host.startswith("unix://"):
+        raise DockerAPIError(0, f"only unix sockets are supported, DOCKER_HOST is {host}")
+    return host[len("unix://"):]
+
+
+# containers.run() keyword arguments that configure the container itself,
+# everything else in docker_options belongs to its host config
+CONTAINER_OPTIONS = {
+    "command", "detach", "domainname", "entrypoint", "environment", "healthcheck", "hostname", "image", "labels",
+    "mac_address", "runtime", "stdin_open", "stop_signal", "stop_timeout", "tty", "user", "working_dir",
+}
+
+
+def create_body(options: dict) -> dict:
+    # the create request containers.run() would send for the same keyword
+    # arguments, so docker_options means the same thing for both APIs
+    from docker.types import ContainerConfig, HostConfig
+
+    host = {k: v for k, v in options.items() if k not in CONTAINER_OPTIONS and k != "name"}
+    container = {k: v for k, v in options.items() if k in CONTAINER_OPTIONS}
+    # run() calls binds volumes and port bindings ports
+    if "volumes" in host:
+        host["binds"] = host.pop("volumes")
+    if "ports" in host:
+        host["port_bindings"] = host.pop("ports")
+        container["ports"] = [tuple(str(x).split("/")) for x in host["port_bindings"]]
+    container.setdefault("command", None)
+    return ContainerConfig(API_VERSION, host_config=HostConfig(API_VERSION, **host), **container)
+
+
+def pull_errors(data: bytes) -> list[str]:
+    # a pull reports progress and failures as a stream of json objects
+    errors = []
+    for line in data.splitlines():
+        try:
+            message = json.loads(line)
+        except ValueError:
+            continue
+        if "error" in message:
+            errors.append(message["error"])
+    return errors
+
+
+def demux(buffer: bytearray) -> list[tuple[int, bytes]]:
+    # exec output without a tty is framed as [stream, 0, 0, 0, size(4)] + data
+    frames = []
+    while len(buffer) >= 8:
+        size = int.from_bytes(buffer[4:8], "big")
+        if len(buffer) < 8 + size:
+            break
+        frames.append((buffer[0], bytes(buffer[8:8 + size])))
+        del buffer[:8 + size]
+    return frames
+
+
+class DockerAPI:
+    def __init__(self, path: Optional[str] = None, limit: int = 64) -> None:
+        self.path = path or socket_path()
+        # a connection per request, capped so hundreds of concurrent calls
+        # don't exhaust the daemon's or our file descriptors
+        self.max_connections = limit
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def limit(self) -> asyncio.Semaphore:
+        # a semaphore belongs to the loop it first waited on, the client
+        # outlives the loop it was created on
+        loop = asyncio.get_running_loop()
+        if self.semaphore is None or self.loop is not loop:
+            self.loop = loop
+            self.semaphore = asyncio.Semaphore(self.max_connections)
+        return self.semaphore
+
+    async def open(self, method: str, path: str, params: Optional[dict] = None, body=None):
+        reader, writer = await asyncio.open_unix_connection(self.path)
+        query = f"?{urllib.parse.urlencode(params)}" if params else ""
+        data = json.dumps(body).encode() if body is not None else b""
+        writer.write(
+            (
+                f"{method} /v{API_VERSION}{path}{query} HTTP/1.1\r\n"
+                "Host: docker\r\n"
+                "Connection: close\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\n\r\n"
+            ).encode()
+            + data
+        )
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b""):
+                break
+            key, _, value = line.decode("latin-1").partition(":")
+            headers[key.strip().lower()] = value.strip()
+        return status, headers, reader, writer
+
+    async def chunks(self, headers: dict, reader: asyncio.StreamReader) -> AsyncIterator[bytes]:
+        if headers.get("transfer-encoding") == "chunked":
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    return
+                yield await reader.readexactly(size)
+                await reader.readexactly(2)
+        elif "content-length" in headers:
+            if int(headers["content-length"]) > 0:
+                yield await reader.readexactly(int(headers["content-length"]))
+        else:
+            # hijacked exec streams run until the daemon closes them
+            while chunk := await reader.read(65536):
+                yield chunk
+
+    async def request(self, method: str, path: str, params: Optional[dict] = None, body=None):
+        async with self.limit:
+            status, headers, reader, writer = await self.open(method, path, params, body)
+            try:
+                data = b"".join([x async for x in self.chunks(headers, reader)])
+            finally:
+                writer.close()
+        if status >= 400:
+            try:
+                message = json.loads(data)["message"]
+            except (ValueError, KeyError):
+                message = data.decode(errors="replace")
+            raise DockerAPIError(status, message)
+        return json.loads(data) if data.strip() else None
+
+    async def stream(self, method: str, path: str, body=None, params: Optional[dict] = None) -> AsyncIterator[bytes]:
+        async with self.limit:
+            status, headers, reader, writer = await self.open(method, path, params, body)
+            try:
+                if status >= 400:
+                    data = b"".join([x async for x in self.chunks(headers, reader)])
+                    raise DockerAPIError(status, data.decode(errors="replace"))
+                async for chunk in self.chunks(headers, reader):
+                    yield chunk
+            finally:
+                writer.close()
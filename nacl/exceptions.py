@@ -16,3 +16,7 @@ class ConfigFileNotFound(Exception):
 
 class ScenarioExists(Exception):
     pass
+
+
+class OrchestrationTimeout(Exception):
+    pass
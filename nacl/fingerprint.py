@@ -0,0 +1,71 @@
+import hashlib
+import json
+import os
+
+import nacl.sync
+
+
+def hash_data(data) -> str:
+    return hashlib.sha256(
+        json.dumps(data, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def hash_tree(path: str) -> str:
+    digest = hashlib.sha256()
+    if os.path.isfile(path):
+        digest.update(nacl.sync.file_digest(path).encode())
+    elif os.path.isdir(path):
+        for rel_path in sorted(nacl.sync.scan_tree(path, nacl.sync.DEFAULT_IGNORE)):
+            digest.update(rel_path.encode())
+            digest.update(nacl.sync.file_digest(f"{path}/{rel_path}").encode())
+    return digest.hexdigest()
+
+
+def formula_files(config: dict) -> dict[str, str]:
+    manifest = nacl.sync.load_manifest(f"{config['running_tmp_dir']}/manifests/{config['formula']}.json")
+    # other scenarios and this scenario's tests never reach the instances
+    return {
+        k: v["hash"]
+        for k, v in manifest.items()
+        if not k.startswith("nacl/")
+        or (
+            k.startswith(f"nacl/{config['scenario']}/")
+            and not k.startswith(f"nacl/{config['scenario']}/tests/")
+        )
+    }
+
+
+def formula_hash(config: dict) -> str:
+    return hash_data(formula_files(config))
+
+
+def instance_grains(config: dict, instance: dict) -> dict:
+    return (config.get("grains") or {}).get(instance["prov_name"].split("_")[-1], {})
+
+
+def apply_context(config: dict, instance: dict) -> dict:
+    # everything besides the formula files that changes what an apply does
+    return {
+        "extra_file_roots": [hash_tree(x) for x in config.get("extra_file_roots", [])],
+        "grains": instance_grains(config, instance),
+        "master_config": config.get("master_config", {}),
+        "salt_exec_mode": config["salt_exec_mode"],
+        "shared_master": config.get("shared_master", False),
+    }
+
+
+def apply_fingerprint(config: dict, instance: dict) -> str:
+    return hash_data({"formula": formula_hash(config), **apply_context(config, instance)})
+
+
+def prepare_fingerprint(config: dict, instance: dict, formula_dir: str, image: str = "") -> str:
+    scenario_path = f"{formula_dir}/{config['formula']}/nacl/{config['scenario']}"
+    return hash_data(
+        {
+            "image": image or instance.get("image", instance.get("box")),
+            "prepare": hash_tree(f"{scenario_path}/prepare.sls"),
+            "pillar": hash_tree(f"{scenario_path}/pillar"),
+            "grains": instance_grains(config, instance),
+        }
+    )
@@ -0,0 +1,123 @@
+import concurrent.futures
+import json
+import os
+import subprocess
+from dataclasses import dataclass, field
+
+import nacl.config
+import nacl.fingerprint
+import nacl.sync
+import nacl.timings
+
+# salt-lint reads its rules from this file in the directory it runs in
+CONFIG_FILE = ".salt-lint"
+
+
+@dataclass
+class LintResult:
+    files: list[str] = field(default_factory=list)
+    cached: list[str] = field(default_factory=list)
+    matches: dict[str, list[dict]] = field(default_factory=dict)
+    errors: list[str] = field(default_factory=list)
+
+    @property
+    def passed(self) -> bool:
+        return self.errors == [] and not any(self.matches.values())
+
+
+def cache_path(cur_dir: str) -> str:
+    return f"{nacl.config.TMP_DIR}lint/{os.path.basename(os.path.abspath(cur_dir))}.json"
+
+
+def config_hash(cur_dir: str) -> str:
+    with nacl.timings.span("salt-lint", "subprocess", cmd="salt-lint --version"):
+        proc = subprocess.run("salt-lint --version", shell=True, capture_output=True)
+    return nacl.fingerprint.hash_data(
+        {
+            "version": proc.stdout.decode(errors="replace").strip(),
+            "config": nacl.fingerprint.hash_tree(f"{cur_dir}/{CONFIG_FILE}"),
+        }
+    )
+
+
+def find_sls(cur_dir: str) -> dict[str, os.stat_result]:
+    # the .sls files the old `salt-lint */*` glob covered, one directory
+    # down and without hidden names, so scenario pillar and prepare.sls
+    # under nacl/<scenario>/ stay out of it
+    files = {}
+    for top in os.scandir(cur_dir):
+        if top.name.startswith(".") or not top.is_dir():
+            continue
+        for entry in os.scandir(top.path):
+            if not entry.name.startswith(".") and entry.name.endswith(".sls") and entry.is_file():
+                files[f"{top.name}/{entry.name}"] = entry.stat()
+    return files
+
+
+def run_salt_lint(cur_dir: str, files: list[str]) -> tuple[dict[str, list[dict]], list[str]]:
+    try:
+        with nacl.timings.span("salt-lint", "subprocess", files=len(files)):
+            proc = subprocess.run(
+                ["salt-lint", "--json", *files], cwd=cur_dir, capture_output=True
+            )
+    except FileNotFoundError:
+        return {}, ["salt-lint is not installed"]
+    matches: dict[str, list[dict]] = {x: [] for x in files}
+    try:
+        found = json.loads(proc.stdout or b"[]")
+    except ValueError:
+        return {}, [proc.stdout.decode(errors="replace") + proc.stderr.decode(errors="replace")]
+    for match in found:
+        matches.setdefault(os.path.relpath(os.path.join(cur_dir, match["filename"]), cur_dir), []).append(match)
+    if proc.returncode not in (0, 2):
+        return {}, [proc.stderr.decode(errors="replace") or f"salt-lint exited with {proc.returncode}"]
+    return matches, []
+
+
+def lint_tree(cur_dir: str, workers: int = 0) -> LintResult:
+    files = find_sls(cur_dir)
+    result = LintResult(files=sorted(files))
+    cache = nacl.sync.load_manifest(cache_path(cur_dir))
+    lint_config = config_hash(cur_dir)
+    new_cache = {}
+    to_lint = []
+    for rel_path in result.files:
+        stat = files[rel_path]
+        entry = cache.get(rel_path)
+        if entry is not None and entry["config"] == lint_config:
+            # size and mtime spare the hash, the hash survives a touch
+            if (entry["size"], entry["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns):
+                digest = nacl.sync.file_digest(f"{cur_dir}/{rel_path}")
+                entry = dict(entry, size=stat.st_size, mtime_ns=stat.st_mtime_ns) if entry["hash"] == digest else None
+            if entry is not None:
+                new_cache[rel_path] = entry
+                result.matches[rel_path] = entry["matches"]
+                result.cached.append(rel_path)
+                continue
+        to_lint.append(rel_path)
+    if to_lint != []:
+        # salt-lint pays its startup per process, so hand every worker one
+        # chunk instead of a file at a time
+        workers = max(1, min(workers or os.cpu_count() or 1, len(to_lint)))
+        chunks = [to_lint[i::workers] for i in range(workers)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            for chunk, future in [(x, pool.submit(run_salt_lint, cur_dir, x)) for x in chunks]:
+                matches, errors = future.result()
+                result.errors += errors
+                for rel_path in chunk:
+                    if rel_path not in matches:
+                        continue
+                    result.matches[rel_path] = matches[rel_path]
+                    new_cache[rel_path] = {
+                        "size": files[rel_path].st_size,
+                        "mtime_ns": files[rel_path].st_mtime_ns,
+                        "hash": nacl.sync.file_digest(f"{cur_dir}/{rel_path}"),
+                        "config": lint_config,
+                        "matches": matches[rel_path],
+                    }
+    nacl.sync.write_manifest(cache_path(cur_dir), new_cache)
+    return result
+
+
+def format_match(match: dict) -> str:
+    return f"[{match.get('id')}] {match.get('message')}\n{match.get('filename')}:{match.get('linenumber')}\n{str(match.get('line', '')).rstrip()}"
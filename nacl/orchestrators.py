@@ -1,6 +1,11 @@
+import concurrent.futures
+import fcntl
 import os
+import shlex
+import socket
 import subprocess
 import sys
+import threading
 
 import shutil
 import yaml
@@ -8,16 +13,68 @@ import json
 import time
 import re
 from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Optional
 from jinja2 import Environment, BaseLoader, select_autoescape
 
-from nacl.exceptions import BootStrapException, NoHostSpecified
+import nacl.fingerprint
+import nacl.state
+import nacl.timings
+import nacl.utils
+from nacl.exceptions import BootStrapException, ConfigException, NoHostSpecified, OrchestrationTimeout
+
+if TYPE_CHECKING:
+    from docker.models.containers import Container
+
+
+PREPARED_IMAGE_REPO = "nacl-prepared"
+MINION_PKI_DIR = "/etc/salt/pki/minion"
+SALT_THIN_DIR = "/var/tmp/nacl-salt"
+# shared by salt-ssh and testinfra, kept short since unix socket paths are
+# limited to ~100 characters
+SSH_MULTIPLEX_OPTIONS = [
+    "ControlMaster=auto",
+    "ControlPath=/tmp/nacl-ssh-%C",
+    "ControlPersist=10m",
+]
+
+
+def entrypoint_changes(image_config: dict) -> list[str]:
+    # Dockerfile instructions that give an image committed from a throwaway
+    # container the entrypoint and command of the image it ran
+    return [
+        f"ENTRYPOINT {json.dumps(image_config.get('Entrypoint') or [])}",
+        f"CMD {json.dumps(image_config.get('Cmd') or [])}",
+    ]
+
+
+def scenario_pillar_top(top: str, env: str) -> str:
+    # a minion with pillarenv set only matches the top entries under that
+    # env, the scenario's own top.sls is written for base
+    return re.sub(r"^(['\"]?)base\1(\s*:)", rf"{env}\2", top, flags=re.M)
+
+
+def split_ssh_config(ssh_config: str) -> dict[str, str]:
+    hosts: dict[str, str] = {}
+    name = None
+    for line in ssh_config.splitlines(keepends=True):
+        if line.startswith("Host "):
+            name = line.split()[1]
+            hosts[name] = ""
+        if name is not None:
+            hosts[name] += line
+    return hosts
 
 
 class Orchestrator(ABC):
     connection_type = ""
+    # set by every orchestrator, master_name only by those running a salt master
+    scenario_dir: str
+    master_name: str
 
     @abstractmethod
-    def orchestrate(self):
+    def orchestrate(self) -> dict[str, str]:
+        # short name -> starting state of every instance this call created
         pass
 
     @abstractmethod
@@ -32,31 +89,122 @@ class Orchestrator(ABC):
     def login(self, host):
         pass
 
-class Docker(Orchestrator):
-    __conf_schema__ = {
-        "image": {"type": str, "required": True},
-        "docker_options": {"type": dict, "required": False},
-        "converge": {"type": bool, "required": False}
-    }
+    def exec(
+        self, name: str, cmd: str, output=None, timeout: Optional[float] = None
+    ) -> subprocess.CompletedProcess:
+        # only needed in salt-master mode, salt-ssh reaches the instances itself
+        raise NotImplementedError(f"{type(self).__name__} can't run commands in its instances")
 
-    def __init__(self, config: dict) -> None:
-        import docker
+    def invalidate_inventory(self):
+        pass
+
+    def commit_prepared(self, instance):
+        pass
+
+    def refresh_pillar_top(self):
+        pass
+
+    def start_shared_master(self) -> None:
+        pass
+
+    def minion_id(self, instance: dict) -> str:
+        return instance["prov_name"].split("_")[-1]
+
+class DockerLayout:
+    # names, paths and container options of a docker scenario, shared by
+    # Docker and the engine API based AsyncDocker
+    connection_type = "docker"
+
+    def init_paths(self, config: dict) -> None:
         self.config = config
         self.scenario_dir = f"{self.config['running_tmp_dir']}docker/{self.config['formula']}/{self.config['scenario']}/nacl/"
         self.formula_dir = f"{self.config['running_tmp_dir']}/formulas"
-        self.client = docker.from_env()
-    
-    def get_inventory(self) -> list[tuple[str]]:
+        self.network_name = f"nacl_{self.config['formula']}_{self.config['scenario']}"
+        self.shared_master = self.config.get("shared_master", False)
+        if self.shared_master:
+            # one master per formula, every scenario gets its own saltenv and
+            # pillarenv named after it
+            if self.config.get("master_config"):
+                raise ConfigException("master_config can't be set per scenario when the salt master is shared")
+            self.master_name = f"nacl_{self.config['formula']}_master"
+            self.master_dir = f"{self.config['running_tmp_dir']}docker/{self.config['formula']}/"
+        else:
+            self.master_name = f"nacl_{self.config['formula']}_{self.config['scenario']}_master"
+            self.master_dir = self.scenario_dir
+
+    def minion_id(self, instance: dict) -> str:
+        # short names repeat across scenarios, which a shared master can't tell apart
+        if self.shared_master:
+            return instance["prov_name"]
+        return instance["prov_name"].split("_")[-1]
+
+    def shared_scenarios(self) -> list[str]:
+        return sorted(
+            x for x in os.listdir(f"{self.formula_dir}/{self.config['formula']}/nacl")
+            if os.path.isdir(f"{self.formula_dir}/{self.config['formula']}/nacl/{x}")
+        )
+
+    def write_pillar_top(self, scenario: str) -> None:
+        # the generated top comes first in the scenario's pillar_roots, so
+        # salt reads it instead of the one next to the pillar files
+        top_path = f"{self.formula_dir}/{self.config['formula']}/nacl/{scenario}/pillar/top.sls"
+        top = ""
+        if os.path.exists(top_path):
+            with open(top_path, "r") as f:
+                top = f.read()
+        os.makedirs(f"{self.master_dir}pillar_tops/{scenario}", exist_ok=True)
+        with open(f"{self.master_dir}pillar_tops/{scenario}/top.sls.tmp", "w") as f:
+            f.write(scenario_pillar_top(top, scenario))
+        os.replace(f"{self.master_dir}pillar_tops/{scenario}/top.sls.tmp", f"{self.master_dir}pillar_tops/{scenario}/top.sls")
+
+    def refresh_pillar_top(self) -> None:
+        # picks up edits to this scenario's pillar top before an apply
+        if self.shared_master:
+            self.write_pillar_top(self.config["scenario"])
+
+    def master_config(self) -> dict:
+        formula_root = f"/srv/salt/formulas/{self.config['formula']}/nacl"
+        if self.shared_master:
+            scenarios = self.shared_scenarios()
+            master_config = {
+                "pillar_roots": {x: [f"/srv/salt/data/pillar_tops/{x}", f"{formula_root}/{x}/pillar"] for x in scenarios},
+                "file_roots": {x: [f"{formula_root}/{x}/saltfs", "/srv/salt/formulas"] for x in scenarios},
+                "auto_accept": True,
+            }
+        else:
+            master_config = {"pillar_roots": {"base": [f"{formula_root}/{self.config['scenario']}/pillar"]}, "file_roots": {"base": [f"{formula_root}/{self.config['scenario']}/saltfs", "/srv/salt/formulas"]}, "auto_accept": True}
+        master_config.update(self.config.get('master_config', {}))
+        return master_config
+
+    def master_options(self) -> dict:
+        labels = {"app": "nacl", "scenario": self.config["scenario"], "formula": self.config["formula"]}
+        if self.shared_master:
+            labels = {"app": "nacl", "formula": self.config["formula"], "role": "shared-master"}
+        master_container_options = {"tty": True, "tmpfs": {"/tmp":"", "/run": ""}, "volumes": [f"{self.formula_dir}:/srv/salt/formulas", f"{self.master_dir}:/srv/salt/data", f"{self.master_dir}/master:/etc/salt/master"], "name": self.master_name, "labels": labels, "detach": True, "hostname": "master", "image": "salt:3006"}
+        master_container_options.update(self.config.get("master_container_options", {}))
+        return master_container_options
+
+    def minion_options(self, instance: dict) -> tuple[dict, dict]:
+        short_name = instance['prov_name'].split("_")[-1]
+        grains = self.config.get("grains", {}).get(short_name, {})
+        minion_config = {"master": "master", "grains": grains}
+        if self.shared_master:
+            minion_config.update(id=self.minion_id(instance), saltenv=self.config["scenario"], pillarenv=self.config["scenario"])
+        instance_container_options = {"tty": True, "tmpfs": {"/tmp":"", "/run": ""}, "volumes": [f"{self.scenario_dir}/{instance['prov_name']}_minion:/etc/salt/minion:z"], "name": instance["prov_name"], "labels": {"app": "nacl", "scenario": self.config["scenario"], "formula": self.config["formula"]}, "detach": True, "hostname": short_name, "image": instance["image"]}
+        instance_container_options.update(instance.get("docker_options", {}))
+        return instance_container_options, minion_config
+
+    def inventory_from(self, containers: dict, known: dict) -> list[tuple[str]]:
         inventory = []
         for instance in self.config["instances"]:
-            cont = self.client.containers.list(filters={"name":instance["prov_name"]})
-            cont += self.client.containers.list(filters={"name":instance["prov_name"], "status": "exited"})
-            if cont == []:
+            short_name = instance["prov_name"].split("_")[-1]
+            cont = containers.get(instance["prov_name"])
+            if cont is None:
                 status = "Not created"
-            elif os.path.exists(f"{self.config['running_tmp_dir']}/{self.config['provider']['name']}/{self.config['formula']}/{self.config['scenario']}/{instance['prov_name']}.prepared"):
-                status = "Prepared"
+            elif known.get(short_name, {}).get("state") in (nacl.state.PREPARED, nacl.state.CONVERGED):
+                status = known[short_name]["state"]
             else:
-                if cont[0].status == "running":
+                if cont.status == "running":
                     status = "Created"
                 else:
                     status = "Created (not running)"
@@ -64,47 +212,307 @@ class Docker(Orchestrator):
 
         return inventory
 
-    def exec(self, name: str, cmd: str) -> subprocess.CompletedProcess:
-        proc = subprocess.run(f"docker exec -it {name} {cmd}", shell=True, capture_output=True)
-        return proc
+    def prepared_image(self, instance: dict) -> str:
+        # keyed on the image the container actually runs, docker_options may
+        # override the instance's
+        image = self.minion_options(instance)[0]["image"]
+        return f"{PREPARED_IMAGE_REPO}:{nacl.fingerprint.prepare_fingerprint(self.config, instance, self.formula_dir, image)}"
+
+    def shell(self, host: str) -> None:
+        cmd = f"docker exec -it nacl_{self.config['formula']}_{self.config['scenario']}_{host} /bin/bash"
+        with nacl.timings.span("docker", "subprocess", cmd=cmd):
+            subprocess.run(cmd, shell=True)
+
+
+class Docker(DockerLayout, Orchestrator):
+    __conf_schema__ = {
+        "image": {"type": str, "required": True},
+        "docker_options": {"type": dict, "required": False},
+        "converge": {"type": bool, "required": False}
+    }
+
+    def __init__(self, config: dict) -> None:
+        import docker
+        self.init_paths(config)
+        self._containers: Optional[dict[str, "Container"]] = None
+        self.client = docker.from_env()
+        self.errors = docker.errors
+
+    def get_containers(self) -> dict[str, "Container"]:
+        # one label filtered query for the whole scenario, reused until
+        # something changes the containers
+        if self._containers is None:
+            self._containers = {
+                x.name: x
+                for x in self.client.containers.list(
+                    all=True,
+                    filters={"label": ["app=nacl", f"formula={self.config['formula']}", f"scenario={self.config['scenario']}"]},
+                )
+            }
+        return self._containers
+
+    def invalidate_inventory(self) -> None:
+        self._containers = None
+
+    def get_master(self):
+        if not self.shared_master:
+            return self.get_containers().get(self.master_name)
+        masters = self.client.containers.list(
+            all=True,
+            filters={"label": ["app=nacl", f"formula={self.config['formula']}", "role=shared-master"]},
+        )
+        return masters[0] if masters != [] else None
+
+    @contextmanager
+    def master_lock(self):
+        # scenarios of a parallel test run share the master, only one of them
+        # may create, reconfigure or remove it at a time
+        os.makedirs(self.master_dir, exist_ok=True)
+        with open(f"{self.master_dir}master.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def master_users(self) -> list:
+        # minions of the formula's other scenarios the shared master serves
+        return [
+            x for x in self.client.containers.list(all=True, filters={"label": ["app=nacl", f"formula={self.config['formula']}"]})
+            if x.labels.get("role") != "shared-master" and x.labels.get("scenario") != self.config["scenario"]
+        ]
+
+    def start_master(self, net=None) -> bool:
+        # returns whether the master has to be waited on before any minion is
+        # targeted, every path that (re)starts it returns True. Called with
+        # the master lock held.
+        master_config = self.master_config()
+        master = self.get_master()
+        if master is not None and os.path.exists(f"{self.master_dir}/master"):
+            with open(f"{self.master_dir}/master", "r") as f:
+                current = json.load(f)
+        else:
+            current = None
+        if self.shared_master:
+            if master is not None and current != master_config and self.master_users() != []:
+                # a restart would kill the jobs other scenarios run through it
+                raise ConfigException(
+                    f"The shared salt master of {self.config['formula']} serves other scenarios with a different set of "
+                    "scenarios, destroy them before adding a new one"
+                )
+            for scenario in self.shared_scenarios():
+                self.write_pillar_top(scenario)
+        with open(f"{self.master_dir}/master", "w") as f:
+            json.dump(master_config, f)
+        if master is None:
+            master = self.client.containers.run(**self.master_options())
+            if net is not None:
+                net.connect(master, aliases=["master"])
+            return True
+        if self.shared_master and net is not None:
+            try:
+                net.connect(master, aliases=["master"])
+            except self.errors.APIError:
+                pass
+        if current != master_config:
+            # a scenario the running master doesn't know about yet, or a
+            # scenario's own master with an edited master_config
+            master.restart()
+            return True
+        if master.status != "running":
+            master.start()
+            return True
+        # a shared master may have just been started by another scenario that
+        # hasn't seen its file server come up yet
+        return self.shared_master
 
-    def orchestrate(self) -> None:
+    def release_master(self) -> None:
+        master = self.get_master()
+        if master is None:
+            return
+        for instance in self.config["instances"]:
+            try:
+                self.exec(self.master_name, f"salt-key -y -d {self.minion_id(instance)}", timeout=60)
+            except (self.errors.APIError, OrchestrationTimeout):
+                pass
+        # this scenario's minions are gone already, anything left is another's
+        if self.master_users() == []:
+            print("==> Removing shared salt master")
+            master.remove(force=True)
+        else:
+            nets = self.client.networks.list(names=[self.network_name])
+            if nets != []:
+                try:
+                    nets[0].disconnect(master, force=True)
+                except self.errors.APIError:
+                    pass
+
+    def start_shared_master(self) -> None:
+        # run once before the scenarios of a test run start, so the master
+        # already serves every scenario's env and none of them restarts it
+        with self.master_lock():
+            started = self.start_master()
+        if started:
+            nacl.utils.wait_for(self.master_ready, "the salt master file server", self.config.get("ready_timeout", 300))
+
+    @nacl.timings.traced
+    def get_inventory(self) -> list[tuple[str]]:
+        return self.inventory_from(self.get_containers(), nacl.state.StateStore().get(self.config))
+
+    @nacl.timings.traced
+    def exec(
+        self, name: str, cmd: str, output=None, timeout: Optional[float] = None
+    ) -> subprocess.CompletedProcess:
+        # runs over the client's API connection, no shell, docker cli or tty,
+        # so stdout and stderr stay apart. With an output callback every line
+        # of both streams is handed to it instead of being collected. Docker
+        # can't stop an exec, a timeout only stops reading from it and leaves
+        # the command running in the container.
+        exec_id = self.client.api.exec_create(
+            name, shlex.split(cmd), stdout=True, stderr=True, tty=False
+        )["Id"]
+        stdout: list[bytes] = []
+        stderr: list[bytes] = []
+        partial = {"stdout": b"", "stderr": b""}
+
+        def emit(stream: str, chunk: bytes) -> None:
+            if output is None:
+                (stdout if stream == "stdout" else stderr).append(chunk)
+                return
+            lines = (partial[stream] + chunk).split(b"\n")
+            partial[stream] = lines.pop()
+            for line in lines:
+                output(line + b"\n")
+
+        import docker.utils.socket
+        # the raw socket instead of the SDK's stream, so a reader blocked on
+        # it can be woken up by shutting the socket down
+        sock = self.client.api.exec_start(exec_id, socket=True)
+        errors: list[Exception] = []
+
+        def read() -> None:
+            try:
+                for stream, data in docker.utils.socket.frames_iter(sock, tty=False):
+                    emit("stdout" if stream == docker.utils.socket.STDOUT else "stderr", data)
+            except Exception as error:
+                errors.append(error)
+
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        reader.join(timeout)
+        if reader.is_alive():
+            getattr(sock, "_sock", sock).shutdown(socket.SHUT_RDWR)
+            reader.join(5)
+            sock.close()
+            raise OrchestrationTimeout(f"Timed out after {timeout}s running '{cmd}' in {name}")
+        sock.close()
+        if errors != []:
+            raise errors[0]
+        if output is not None:
+            for rest in partial.values():
+                if rest != b"":
+                    output(rest)
+        # the stream can close before the daemon has recorded the exit code
+        inspect = {}
+
+        def exited() -> bool:
+            inspect.update(self.client.api.exec_inspect(exec_id))
+            return not inspect["Running"]
+
+        nacl.utils.wait_for(exited, f"'{cmd}' in {name} to exit", 60, delay=0.05)
+        return subprocess.CompletedProcess(cmd, inspect["ExitCode"], b"".join(stdout), b"".join(stderr))
+
+    def cached_image(self, instance: dict) -> Optional[str]:
+        if not self.config.get("image_cache", False):
+            return None
+        image = self.prepared_image(instance)
+        try:
+            self.client.images.get(image)
+        except self.errors.ImageNotFound:
+            return None
+        return image
+
+    def commit_prepared(self, instance: dict) -> None:
+        if not self.config.get("image_cache", False):
+            return
+        cont = self.get_containers()[instance["prov_name"]]
+        repository, tag = self.prepared_image(instance).split(":")
+        # the identity and keypair the minion picked up are dropped so
+        # containers started from the image generate their own, but only in
+        # a throwaway copy, the live minion keeps authenticating with its key
+        snapshot = cont.commit()
+        scratch = self.client.containers.run(
+            snapshot.id, [MINION_PKI_DIR, "/etc/salt/minion_id"], entrypoint=["rm", "-rf"], detach=True
+        )
+        try:
+            scratch.wait()
+            scratch.commit(repository=repository, tag=tag, changes=entrypoint_changes(snapshot.attrs["Config"]))
+        finally:
+            scratch.remove(force=True)
+            self.client.images.remove(snapshot.id)
+        print(f"==> Cached prepared image for {instance['prov_name'].split('_')[-1]}")
+
+    def master_ready(self) -> bool:
+        try:
+            proc = self.exec(self.master_name, "salt-run fileserver.dir_list", timeout=60)
+        except (self.errors.APIError, OrchestrationTimeout):
+            return False
+        return proc.returncode == 0 and b"ERROR" not in proc.stdout + proc.stderr
+
+    def minions_ready(self, minions: list[str]) -> bool:
+        try:
+            accepted = json.loads(self.exec(self.master_name, "salt-key list --out=json", timeout=60).stdout)["minions"]
+        except (ValueError, KeyError, self.errors.APIError, OrchestrationTimeout):
+            return False
+        waiting = [x for x in minions if x not in accepted]
+        if waiting != []:
+            print(f"==> Waiting for {', '.join(waiting)} to come up...")
+        return waiting == []
+
+    @nacl.timings.traced
+    def orchestrate(self) -> dict[str, str]:
         if not os.path.exists(self.scenario_dir):
             os.makedirs(self.scenario_dir)
-        nets = self.client.networks.list(names=[f"nacl_{self.config['formula']}_{self.config['scenario']}"])  
+        nets = self.client.networks.list(names=[self.network_name])
         if nets == []:
-            net = self.client.networks.create(f"nacl_{self.config['formula']}_{self.config['scenario']}")
+            net = self.client.networks.create(self.network_name)
         else:
             net = nets[0]
-        if self.client.containers.list(filters={"name": f"nacl_{self.config['formula']}_{self.config['scenario']}_master"}) == []:
-            master_config = {"pillar_roots": {"base": [f"/srv/salt/formulas/{self.config['formula']}/nacl/{self.config['scenario']}/pillar"]}, "file_roots": {"base": ["/srv/salt/formulas/{self.config['formula']}/nacl/{self.config['scenario']}/saltfs", "/srv/salt/formulas"]}, "auto_accept": True}
-            master_config.update(self.config.get('master_config', {}))
-            with open(f"{self.scenario_dir}/master", "w") as f:
-                json.dump(master_config, f)
-            master_container_options = {"tty": True, "tmpfs": {"/tmp":"", "/run": ""}, "volumes": [f"{self.formula_dir}:/srv/salt/formulas", f"{self.scenario_dir}:/srv/salt/data", f"{self.scenario_dir}/master:/etc/salt/master"], "name": f"nacl_{self.config['formula']}_{self.config['scenario']}_master", "labels": {"app": "nacl", "scenario": self.config["scenario"], "formula": self.config["formula"]}, "detach": True, "hostname": "master", "image": "salt:3006"}
-            master_container_options.update(self.config.get("master_container_options", {}))
-            master_container = self.client.containers.run(**master_container_options)
-            while b"ERROR" in self.exec(f"nacl_{self.config['formula']}_{self.config['scenario']}_master", "salt-run fileserver.dir_list").stdout:
-                time.sleep(1)
-            net.connect(master_container, aliases=["master"])
-        for instance in self.config["instances"]:
-            short_name = instance['prov_name'].split("_")[-1]
-            if self.client.containers.list(filters={"name":instance['prov_name']}) == []:
-                if short_name in self.config["grains"]:
-                    grains = self.config["grains"][short_name]
+        containers = self.get_containers()
+        timeout = self.config.get("ready_timeout", 300)
+        # the lock is held until this scenario's minions exist, so a shared
+        # master can't be removed by another scenario's cleanup in between
+        with self.master_lock():
+            new_master = self.start_master(net)
+            # minions retry the master on their own, so every container boots
+            # alongside the master and readiness is checked once for all of them
+            started = []
+            created = {}
+            for instance in self.config["instances"]:
+                short_name = instance['prov_name'].split("_")[-1]
+                if instance["prov_name"] in containers:
+                    if containers[instance["prov_name"]].status != "running":
+                        containers[instance["prov_name"]].start()
+                        started.append(self.minion_id(instance))
                 else:
-                    grains = {}
-                minion_config = {"master": "master", "grains": grains}
-                instance_container_options = {"tty": True, "tmpfs": {"/tmp":"", "/run": ""}, "volumes": [f"{self.scenario_dir}/{instance['prov_name']}_minion:/etc/salt/minion:z"], "name": instance["prov_name"], "labels": {"app": "nacl", "scenario": self.config["scenario"], "formula": self.config["formula"]}, "detach": True, "hostname": instance["prov_name"].split("_")[-1], "image": instance["image"]}
-                instance_container_options.update(instance.get("docker_options", {}))
-                with open(f"{self.scenario_dir}/{instance['prov_name']}_minion", "w") as f:
-                    json.dump(minion_config, f)
-                cont = self.client.containers.run(**instance_container_options)
-                net.connect(cont, aliases=[instance["prov_name"].split("_")[-1]])
-                while instance_container_options["hostname"] not in json.loads(self.exec(master_container.name, "salt-key list --out=json").stdout)["minions"]:
-                    print(f"==> Waiting for {instance['prov_name'].split('_')[-1]} to come up...")
-                    time.sleep(1)
-
+                    instance_container_options, minion_config = self.minion_options(instance)
+                    created[short_name] = nacl.state.CREATED
+                    cached = self.cached_image(instance)
+                    if cached is not None:
+                        instance_container_options["image"] = cached
+                        print(f"==> Using cached prepared image for {short_name}")
+                        created[short_name] = nacl.state.PREPARED
+                    with open(f"{self.scenario_dir}/{instance['prov_name']}_minion", "w") as f:
+                        json.dump(minion_config, f)
+                    cont = self.client.containers.run(**instance_container_options)
+                    net.connect(cont, aliases=[short_name])
+                    started.append(self.minion_id(instance))
+        if new_master:
+            nacl.utils.wait_for(self.master_ready, "the salt master file server", timeout)
+        if started != []:
+            nacl.utils.wait_for(lambda: self.minions_ready(started), "minion keys to be accepted", timeout)
+        self.invalidate_inventory()
+        return created
 
     def login(self, host: str) -> None:
         if host == "":
@@ -112,28 +520,34 @@ class Docker(Orchestrator):
             if len(inv) > 1:
                 print("More than one host exists in scenarios, please specify with --host which one you wish to connect to")
                 return
-            host = inv[0]
-        subprocess.run(
-            f"docker exec -it nacl_{self.config['formula']}_{self.config['scenario']}_{host} /bin/bash",
-            shell=True,
-        )
+            host = inv[0][0]
+        self.shell(host)
 
+    @nacl.timings.traced
     def cleanup(self) -> None:
-        existing_containers = self.client.containers.list(filters={"label": ["app=nacl", f"formula={self.config['formula']}", f"scenario={self.config['scenario']}"]})
-        existing_containers += self.client.containers.list(filters={"label": ["app=nacl", f"formula={self.config['formula']}", f"scenario={self.config['scenario']}"], "status": "exited"})
-
-        for instance in existing_containers:
+        containers = self.get_containers()
+        for instance in containers.values():
             print(f"==> Removing instance {instance.name.split('_')[-1]}")
             instance.remove(force=True)
-        nets = self.client.networks.list(names=[f"nacl_{self.config['formula']}_{self.config['scenario']}"])  
+        # a scenario without minions never used the master, the destroy that
+        # opens a test run leaves the master set up for it alone
+        if self.shared_master and containers != {}:
+            with self.master_lock():
+                self.release_master()
+        nets = self.client.networks.list(names=[self.network_name])
         if nets != []:
             nets[0].remove()
 
         if os.path.exists(self.scenario_dir):
             shutil.rmtree(self.scenario_dir)
-    
+        nacl.state.StateStore().remove_scenario(self.config)
+        self.invalidate_inventory()
+
 
-class Vagrant(Orchestrator):
+class VagrantLayout:
+    # the Vagrantfile, salt-ssh files and machine state lookups of a vagrant
+    # scenario, shared by Vagrant and AsyncVagrant
+    connection_type = "ssh"
     VAGRANT_FILE = """\n
     Vagrant.configure("2") do | config |
         {% for instance in instances %}
@@ -149,6 +563,9 @@ class Vagrant(Orchestrator):
                 {{ instance.prov_name }}.{{ line }}
                 {% endfor %}
                 {{ instance.prov_name }}.vm.provider "{{ provider }}" do |{{ provider }}, override|
+                {% if instance.linked_clone %}
+                    {{ provider }}.linked_clone = true
+                {% endif %}
                 {% if 'provider_raw_config_args' in instance %}
                 {% for line in instance.provider_raw_config_args %}
                     {{ provider }}.{{ line }}
@@ -159,43 +576,74 @@ class Vagrant(Orchestrator):
         {% endfor %}
     end
     """
-    __conf_schema__ = {
-        "box": {"type": str, "required": True},
-        "bootstrap": False,
-        "converge": {"type": bool, "required": False},
-        "provider_raw_config_args": {"type": list, "required": False},
-        "instance_raw_config_args": {"type": list, "required": False}
-    }
 
-    def __init__(self, config: dict) -> None:
-        import vagrant
+    def init_paths(self, config: dict) -> None:
         self.config = config
         self.scenario_dir = f"{self.config['running_tmp_dir']}vagrant/{self.config['formula']}/{self.config['scenario']}/nacl/"
         self.formula_dir = f"{self.config['running_tmp_dir']}/formulas"
-        self.vagrant = vagrant.Vagrant(
-            self.scenario_dir, quiet_stdout=False, quiet_stderr=False
-        )
+        self._machine_states: Optional[dict[str, str]] = None
 
-    def get_inventory(self) -> list[tuple[str]]:
+    def invalidate_inventory(self) -> None:
+        self._machine_states = None
+
+    def index_states(self) -> Optional[dict[str, str]]:
+        # vagrant keeps every machine it manages in a global machine index,
+        # reading it is much cheaper than starting `vagrant status`. None
+        # means the index can't be trusted for this scenario.
+        vagrant_home = os.getenv("VAGRANT_HOME", f"{os.getenv('HOME')}/.vagrant.d")
+        index_path = f"{vagrant_home}/data/machine-index/index"
+        try:
+            with open(index_path, "r") as index_file:
+                index = json.load(index_file)
+            index_mtime = os.path.getmtime(index_path)
+        except (OSError, ValueError):
+            return None
+        project = os.path.normpath(self.scenario_dir)
+        machines = {
+            uuid: x for uuid, x in index.get("machines", {}).items()
+            if os.path.normpath(x.get("vagrantfile_path") or "") == project
+        }
+        states = {}
+        for instance in self.config["instances"]:
+            name = instance["prov_name"]
+            entries = [(uuid, x) for uuid, x in machines.items() if x.get("name") == name]
+            machine_dir = f"{project}/.vagrant/machines/{name}"
+            ids = []
+            if os.path.isdir(machine_dir):
+                for provider in os.listdir(machine_dir):
+                    if os.path.exists(f"{machine_dir}/{provider}/id"):
+                        ids.append(f"{machine_dir}/{provider}/id")
+            if ids == [] and entries == []:
+                states[name] = "not_created"
+            elif len(ids) != 1 or len(entries) != 1:
+                return None
+            elif os.path.getmtime(ids[0]) > index_mtime:
+                # the machine changed after vagrant last wrote the index
+                return None
+            else:
+                states[name] = entries[0][1].get("state") or "not_created"
+        return states
+
+    def inventory_from(self, states: dict[str, str], known: dict) -> list[tuple[str]]:
         inventory = []
-        if not os.path.exists(f"{self.scenario_dir}/Vagrantfile"):
-            for instance in self.config["instances"]:
-                inventory.append((instance["prov_name"].split("_")[-1], "Not created"))
-        else:
-            for instance in self.vagrant.status():
-                if os.path.exists(f"{self.config['running_tmp_dir']}/{self.config['provider']['name']}/{self.config['formula']}/{self.config['scenario']}/{instance.name}.prepared"):
-                    status = "Prepared"
-                else:
-                    status = instance.state
-                inventory.append((instance.name.split("_")[-1], status))
+        for instance in self.config["instances"]:
+            short_name = instance["prov_name"].split("_")[-1]
+            state = states.get(instance["prov_name"], "not_created")
+            if state == "not_created":
+                status = "Not created"
+            elif known.get(short_name, {}).get("state") in (nacl.state.PREPARED, nacl.state.CONVERGED):
+                status = known[short_name]["state"]
+            else:
+                status = state
+            inventory.append((short_name, status))
 
         return inventory
 
-    def orchestrate(self) -> None:
+    def write_vagrantfile(self) -> None:
         if not os.path.exists(self.scenario_dir):
             os.makedirs(self.scenario_dir)
         vagrant_template = Environment(loader=BaseLoader).from_string(
-            Vagrant.VAGRANT_FILE
+            self.VAGRANT_FILE
         )
         data = vagrant_template.render(
             instances=self.config["instances"],
@@ -207,45 +655,107 @@ class Vagrant(Orchestrator):
         )
         with open(f"{self.scenario_dir}/Vagrantfile", "w") as vf:
             vf.write(data)
-        self.vagrant.up()
-        if self.config["salt_exec_mode"] == "salt-ssh":
-            roster = {}
-            master = {}
-            master["file_roots"] = dict(base=[self.formula_dir, f"{self.formula_dir}/{self.config['formula']}/nacl/{self.config['scenario']}"] + self.config.get("extra_file_roots", []))
-            master["pillar_roots"] = dict(
-                base=[
-                    f"{self.formula_dir}/{self.config['formula']}/nacl/{self.config['scenario']}/pillar"
-                ]
-            )
-            ssh_config_full = ""
-            master.update(self.config['master_config'])
-            for vm in self.config["instances"]:
-                ssh_config = self.vagrant.ssh_config(vm_name=vm["prov_name"])
-                ssh_port = re.findall(r"\sPort (\d*)", ssh_config)[0]
-                ident_file = re.findall(r"\sIdentityFile (.*)", ssh_config)[0]
-                roster[vm["prov_name"]] = dict(
-                    host="127.0.0.1", user="vagrant", port=ssh_port, sudo=True, priv=ident_file
-                )
-                ssh_config_full += ssh_config
-            with open(f"{self.scenario_dir}/roster", "w") as roster_file:
-                roster_file.write(yaml.dump(roster))
-            salt_config = {}
-            salt_config["salt-ssh"] = dict(
-                roster_file=f"{self.scenario_dir}roster",
-                config_dir=self.scenario_dir,
-                log_file=f"{self.scenario_dir}salt_log.txt",
-                ssh_log_file=f"{self.scenario_dir}salt_ssh_log.txt",
-                pki_dir=f"{self.scenario_dir}pki",
-                cache_dir=f"{self.scenario_dir}cache",
-                ssh_options=["StrictHostKeyChecking=no"],
-                ssh_priv=""
+
+    def write_salt_ssh_files(self, ssh_config_full: str) -> None:
+        roster = {}
+        master = {}
+        master["file_roots"] = dict(base=[self.formula_dir, f"{self.formula_dir}/{self.config['formula']}/nacl/{self.config['scenario']}"] + self.config.get("extra_file_roots", []))
+        master["pillar_roots"] = dict(
+            base=[
+                f"{self.formula_dir}/{self.config['formula']}/nacl/{self.config['scenario']}/pillar"
+            ]
+        )
+        master.update(self.config['master_config'])
+        ssh_configs = split_ssh_config(ssh_config_full)
+        for vm in self.config["instances"]:
+            ssh_config = ssh_configs[vm["prov_name"]]
+            ssh_port = re.findall(r"\sPort (\d*)", ssh_config)[0]
+            ident_file = re.findall(r"\sIdentityFile (.*)", ssh_config)[0]
+            host = re.findall(r"\sHostName (.*)", ssh_config)
+            # a fixed thin_dir lets later phases reuse the deployed thin
+            roster[vm["prov_name"]] = dict(
+                host=host[0].strip() if host else "127.0.0.1", user="vagrant", port=ssh_port, sudo=True, priv=ident_file.strip().strip('"'), thin_dir=SALT_THIN_DIR
             )
-            with open(f"{self.scenario_dir}/Saltfile", "w") as salt_file:
-                salt_file.write(yaml.dump(salt_config))
-            with open(f"{self.scenario_dir}master", "w") as master_file:
-                master_file.write(yaml.dump(master))
-            with open(f"{self.scenario_dir}ssh_config", "w") as ssh_config_file:
-                ssh_config_file.write(ssh_config_full)
+        with open(f"{self.scenario_dir}/roster", "w") as roster_file:
+            roster_file.write(yaml.dump(roster))
+        salt_config = {}
+        salt_config["salt-ssh"] = dict(
+            roster_file=f"{self.scenario_dir}roster",
+            config_dir=self.scenario_dir,
+            log_file=f"{self.scenario_dir}salt_log.txt",
+            ssh_log_file=f"{self.scenario_dir}salt_ssh_log.txt",
+            pki_dir=f"{self.scenario_dir}pki",
+            cache_dir=f"{self.scenario_dir}cache",
+            ssh_options=["StrictHostKeyChecking=no"] + SSH_MULTIPLEX_OPTIONS,
+            ssh_max_procs=self.config.get("apply_parallelism", len(self.config["instances"])),
+            ssh_priv=""
+        )
+        with open(f"{self.scenario_dir}/Saltfile", "w") as salt_file:
+            salt_file.write(yaml.dump(salt_config))
+        with open(f"{self.scenario_dir}master", "w") as master_file:
+            master_file.write(yaml.dump(master))
+        with open(f"{self.scenario_dir}ssh_config", "w") as ssh_config_file:
+            ssh_config_file.write(ssh_config_full)
+            ssh_config_file.write("\nHost *\n" + "".join(f"  {x.replace('=', ' ', 1)}\n" for x in SSH_MULTIPLEX_OPTIONS))
+
+    def shell(self, host: str) -> None:
+        cmd = f"vagrant ssh nacl_{self.config['formula']}_{self.config['scenario']}_{host}"
+        with nacl.timings.span("vagrant", "subprocess", cmd=cmd):
+            subprocess.run(cmd, shell=True, cwd=self.scenario_dir)
+
+
+class Vagrant(VagrantLayout, Orchestrator):
+    __conf_schema__ = {
+        "box": {"type": str, "required": True},
+        "bootstrap": False,
+        "converge": {"type": bool, "required": False},
+        "provider_raw_config_args": {"type": list, "required": False},
+        "instance_raw_config_args": {"type": list, "required": False},
+        "linked_clone": {"type": bool, "required": False},
+    }
+
+    def __init__(self, config: dict) -> None:
+        import vagrant
+        self.init_paths(config)
+        self.vagrant = vagrant.Vagrant(
+            self.scenario_dir, quiet_stdout=False, quiet_stderr=False
+        )
+
+    def machine_states(self) -> dict[str, str]:
+        if self._machine_states is None:
+            if not os.path.exists(f"{self.scenario_dir}/Vagrantfile"):
+                self._machine_states = {x["prov_name"]: "not_created" for x in self.config["instances"]}
+            else:
+                states = self.index_states()
+                if states is None:
+                    states = {x.name: x.state for x in self.vagrant.status()}
+                self._machine_states = states
+        return self._machine_states
+
+    @nacl.timings.traced
+    def get_inventory(self) -> list[tuple[str]]:
+        return self.inventory_from(self.machine_states(), nacl.state.StateStore().get(self.config))
+
+    @nacl.timings.traced
+    def orchestrate(self) -> dict[str, str]:
+        before = self.machine_states()
+        self.write_vagrantfile()
+        # one `vagrant up` per machine in a pool instead of a single serial up
+        instances = self.config["instances"]
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, self.config["provider"].get("up_parallelism", len(instances)))
+        ) as pool:
+            for future in [pool.submit(self.vagrant.up, vm_name=x["prov_name"]) for x in instances]:
+                future.result()
+        if self.config["salt_exec_mode"] == "salt-ssh":
+            # a single multi-machine ssh-config call instead of one per vm
+            self.write_salt_ssh_files(self.vagrant.ssh_config())
+        self.invalidate_inventory()
+        return {
+            x["prov_name"].split("_")[-1]: nacl.state.CREATED
+            for x in instances
+            if before.get(x["prov_name"], "not_created") == "not_created"
+        }
 
     def login(self, host: str) -> None:
         if host == "":
@@ -253,15 +763,14 @@ class Vagrant(Orchestrator):
             if len(inv) > 1:
                 print("More than one host exists in scenarios, please specify with --host which one you wish to connect to")
                 return
-            host = inv[0].split("_")[-1]
-        subprocess.run(
-            f"vagrant ssh nacl_{self.config['formula']}_{self.config['scenario']}_{host}",
-            shell=True,
-            cwd=self.scenario_dir,
-        )
+            host = inv[0][0]
+        self.shell(host)
 
+    @nacl.timings.traced
     def cleanup(self) -> None:
         if os.path.exists(f"{self.scenario_dir}/Vagrantfile"):
             self.vagrant.destroy()
         if os.path.exists(self.scenario_dir):
             shutil.rmtree(self.scenario_dir)
+        nacl.state.StateStore().remove_scenario(self.config)
+        self.invalidate_inventory()
@@ -0,0 +1,130 @@
+import json
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+@dataclass
+class StateResult:
+    id: str
+    name: str
+    function: str
+    sls: str
+    result: Optional[bool]
+    changes: dict
+    duration: float
+    comment: str
+
+    @property
+    def changed(self) -> bool:
+        return self.changes != {}
+
+
+@dataclass
+class InstanceResult:
+    states: list[StateResult] = field(default_factory=list)
+    errors: list[str] = field(default_factory=list)
+
+    @property
+    def failed(self) -> list[StateResult]:
+        return [x for x in self.states if x.result is False]
+
+    @property
+    def changed(self) -> list[StateResult]:
+        return [x for x in self.states if x.changed]
+
+    @property
+    def pending(self) -> list[StateResult]:
+        # with test=True, states that would change report result None
+        return [x for x in self.states if x.result is None or x.changed]
+
+    @property
+    def duration(self) -> float:
+        return sum(x.duration for x in self.states)
+
+
+def parse_documents(text: str) -> list:
+    # salt prints one JSON document per minion and may surround them with
+    # warnings, so decode every document we can find and skip the rest
+    decoder = json.JSONDecoder()
+    documents = []
+    pos = text.find("{")
+    while pos != -1:
+        try:
+            document, end = decoder.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            pos = text.find("{", pos + 1)
+            continue
+        documents.append(document)
+        pos = text.find("{", end)
+    return documents
+
+
+def parse_state(key: str, data: dict) -> StateResult:
+    parts = key.split("_|-")
+    function = f"{parts[0]}.{parts[-1]}" if len(parts) == 4 else key
+    duration = data.get("duration", 0)
+    if isinstance(duration, str):
+        duration = float(duration.split(" ")[0])
+    comment = data.get("comment", "")
+    if isinstance(comment, list):
+        comment = "\n".join(str(x) for x in comment)
+    return StateResult(
+        id=data.get("__id__", parts[1] if len(parts) == 4 else key),
+        name=str(data.get("name", parts[2] if len(parts) == 4 else key)),
+        function=function,
+        sls=data.get("__sls__", ""),
+        result=data.get("result"),
+        changes=data.get("changes") or {},
+        duration=float(duration),
+        comment=str(comment),
+    )
+
+
+def parse_minion(ret) -> InstanceResult:
+    result = InstanceResult()
+    # salt-ssh reports the states as a job return, or the raw shim output
+    # when it could not run them at all
+    if isinstance(ret, dict) and "return" in ret and "retcode" in ret:
+        ret = ret["return"]
+    if isinstance(ret, dict) and "retcode" in ret and "stderr" in ret:
+        result.errors = [x for x in (ret.get("stderr"), ret.get("stdout")) if x]
+        if result.errors == []:
+            result.errors = [f"salt-ssh exited with {ret['retcode']}"]
+    elif isinstance(ret, list):
+        result.errors = [str(x) for x in ret]
+    elif isinstance(ret, dict):
+        for key, data in sorted(
+            ret.items(),
+            key=lambda x: x[1].get("__run_num__", 0) if isinstance(x[1], dict) else 0,
+        ):
+            if isinstance(data, dict):
+                result.states.append(parse_state(key, data))
+            else:
+                result.errors.append(f"{key}: {data}")
+    else:
+        result.errors = [str(ret)]
+    return result
+
+
+def parse_output(text: str) -> dict[str, InstanceResult]:
+    minions = {}
+    for document in parse_documents(text):
+        if not isinstance(document, dict):
+            continue
+        for minion, ret in document.items():
+            minions[minion] = parse_minion(ret)
+    return minions
+
+
+def format_report(name: str, result: InstanceResult) -> str:
+    lines = []
+    for state in result.failed:
+        lines.append(f"    [x] {state.id} ({state.function}) in {state.sls or '?'}: {state.comment}")
+    for error in result.errors:
+        lines.append(f"    [x] {error}")
+    lines.append(
+        f"==> {name}: Succeeded: {len(result.states) - len(result.failed)} "
+        f"(changed={len(result.changed)}) Failed: {len(result.failed)} "
+        f"Total run time: {result.duration / 1000:.3f} s"
+    )
+    return "\n".join(lines)
@@ -0,0 +1,154 @@
+import concurrent.futures
+import os
+import sys
+import threading
+import time
+import traceback
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+import nacl.config
+import nacl.timings
+
+
+@dataclass
+class ScenarioResult:
+    scenario: str
+    passed: bool
+    duration: float
+    log_file: Optional[str] = None
+    error: str = ""
+    events: list[dict] = field(default_factory=list)
+
+
+def get_log_file(cur_dir: str, scenario: str) -> str:
+    log_dir = f"{nacl.config.TMP_DIR}logs/{os.path.basename(cur_dir.rstrip('/'))}"
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir, exist_ok=True)
+    return f"{log_dir}/{scenario}.log"
+
+
+def tee(fd: int, targets: list[int]) -> None:
+    while chunk := os.read(fd, 65536):
+        for target in targets:
+            os.write(target, chunk)
+    os.close(fd)
+
+
+def run_scenario(
+    pipeline: Callable,
+    args,
+    cur_dir: str,
+    scenario: str,
+    log_file: Optional[str] = None,
+    trace: bool = False,
+    echo: bool = False,
+) -> ScenarioResult:
+    # a spawned worker starts from a fresh module, tracing is switched on
+    # here rather than inherited from the parent
+    if trace:
+        nacl.timings.TRACER.enabled = True
+    # output is redirected at the fd level so salt-ssh, pytest and any other
+    # child process started by the pipeline lands in the scenario log as
+    # well, with echo it still reaches the terminal through a pipe
+    saved_fds = []
+    copier = None
+    if log_file is not None:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        log = open(log_file, "w")
+        saved_fds = [os.dup(1), os.dup(2)]
+        target = log.fileno()
+        if echo:
+            read_fd, target = os.pipe()
+            copier = threading.Thread(target=tee, args=(read_fd, [log.fileno(), saved_fds[0]]), daemon=True)
+            copier.start()
+        os.dup2(target, 1)
+        os.dup2(target, 2)
+        if echo:
+            os.close(target)
+    start = time.monotonic()
+    passed = True
+    error = ""
+    mark = len(nacl.timings.TRACER.events)
+    try:
+        with nacl.timings.span(scenario, "scenario"):
+            pipeline(args, cur_dir, scenario)
+    except SystemExit as exit:
+        if exit.code not in (0, None):
+            passed = False
+            error = f"exited with status {exit.code}"
+    except Exception as exc:
+        traceback.print_exc()
+        passed = False
+        error = f"{type(exc).__name__}: {exc}"
+    finally:
+        duration = time.monotonic() - start
+        if log_file is not None:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_fds[0], 1)
+            os.dup2(saved_fds[1], 2)
+            if copier is not None:
+                # a process the pipeline left running in the background may
+                # hold the pipe open, its output isn't waited for
+                copier.join(5)
+            for fd in saved_fds:
+                os.close(fd)
+            log.close()
+    return ScenarioResult(
+        scenario, passed, duration, log_file, error, nacl.timings.TRACER.events[mark:]
+    )
+
+
+def run_scenarios(
+    pipeline: Callable,
+    args,
+    cur_dir: str,
+    scenarios: list[str],
+    parallelism: int = 1,
+    trace: bool = False,
+) -> list[ScenarioResult]:
+    workers = max(1, min(parallelism, len(scenarios)))
+    results = []
+    if workers == 1:
+        # one scenario at a time keeps its output on the terminal too
+        for scenario in scenarios:
+            results.append(run_scenario(pipeline, args, cur_dir, scenario, get_log_file(cur_dir, scenario), trace, echo=True))
+        return results
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for scenario in scenarios:
+            log_file = get_log_file(cur_dir, scenario)
+            print(f"> Starting Test of scenario {scenario} (log: {log_file})")
+            futures[pool.submit(run_scenario, pipeline, args, cur_dir, scenario, log_file, trace)] = scenario
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as exc:
+                result = ScenarioResult(futures[future], False, 0.0, error=f"{type(exc).__name__}: {exc}")
+            print(f"==> Scenario {result.scenario} {'passed' if result.passed else 'failed'} in {result.duration:.1f}s")
+            # spans recorded in the workers only exist in their copy of the tracer
+            nacl.timings.TRACER.events.extend(result.events)
+            results.append(result)
+    results.sort(key=lambda x: scenarios.index(x.scenario))
+    return results
+
+
+def print_summary(results: list[ScenarioResult]) -> None:
+    print("> Test summary")
+    width = max([len("Scenario")] + [len(x.scenario) for x in results])
+    print("Scenario".ljust(width), "\t", "Result", "\t", "Duration", "\t", "Log")
+    for result in results:
+        print(
+            result.scenario.ljust(width),
+            "\t",
+            "passed" if result.passed else "FAILED",
+            "\t",
+            f"{result.duration:.1f}s",
+            "\t",
+            result.log_file or "-",
+        )
+    for result in results:
+        if result.error:
+            print(f"[x] {result.scenario}: {result.error}", file=sys.stderr)
@@ -0,0 +1,227 @@
+import os
+import re
+from typing import Optional
+
+import nacl.fingerprint
+import nacl.sync
+
+INCLUDE_ITEM_RE = re.compile(r"^\s*-\s*['\"]?([\w.\-]+)['\"]?\s*$")
+TOP_KEY_RE = re.compile(r"^['\"]?([^\s'\"#:][^'\"]*?)['\"]?:\s*$")
+REQUISITE_RE = re.compile(r"^\s*-?\s*(require|watch|onchanges|onfail|prereq|listen|use)(_in|_any)?:\s*$")
+REQUISITE_ITEM_RE = re.compile(r"^\s*-\s*(\w+):\s*['\"]?([^'\"\s]+)")
+JINJA_RE = re.compile(r"{{|{%")
+SALT_URL_RE = re.compile(r"salt://((?:{{[^}]*}}|[^\s'\"\)\]},{])+)")
+JINJA_IMPORT_RE = re.compile(r"{%-?\s*(?:import|from|include)\s+['\"]([^'\"]+)['\"]")
+# jinja variables salt sets for every sls, enough to resolve the usual
+# salt://{{ tpldir }}/files/... sources
+TEMPLATE_VARS = {
+    "tpldir": lambda name, path: os.path.dirname(path),
+    "slspath": lambda name, path: os.path.dirname(path),
+    "tplroot": lambda name, path: path.split("/")[0],
+}
+TEMPLATE_VAR_RE = re.compile(r"{{-?\s*(\w+)\s*-?}}")
+
+
+def index_path(config: dict) -> str:
+    return f"{config['running_tmp_dir']}/sls_index/{config['formula']}/{config['scenario']}.json"
+
+
+def fileserver_path(config: dict, rel_path: str) -> str:
+    # the formula repo is served under its name, the scenario's own
+    # directory (salt-ssh) or saltfs (salt-master) at the root
+    scenario = f"nacl/{config['scenario']}/"
+    if config["salt_exec_mode"] == "salt-master" and rel_path.startswith(f"{scenario}saltfs/"):
+        return rel_path[len(f"{scenario}saltfs/"):]
+    if config["salt_exec_mode"] == "salt-ssh" and rel_path.startswith(scenario) and not rel_path.startswith(f"{scenario}pillar/"):
+        return rel_path[len(scenario):]
+    return f"{config['formula']}/{rel_path}"
+
+
+def sls_name(path: str) -> str:
+    name = path[: -len(".sls")]
+    if name.endswith("/init"):
+        name = name[: -len("/init")]
+    return name.replace("/", ".")
+
+
+def resolve(ref: str, name: str, path: str) -> str:
+    if not ref.startswith("."):
+        return ref
+    # relative to the package the sls lives in
+    package = name if path.endswith("/init.sls") else name.rpartition(".")[0]
+    return f"{package}.{ref.lstrip('.')}" if package else ref.lstrip(".")
+
+
+def parse_sls(text: str, path: str) -> dict:
+    name = sls_name(path)
+    entry: dict = {"sls": name, "includes": [], "ids": [], "requires": [], "required_by": [], "files": [], "dynamic": False}
+    in_include = False
+    requisite = None
+    for line in text.splitlines():
+        if line.strip() == "" or line.lstrip().startswith(("#", "{%", "{#")):
+            continue
+        indent = len(line) - len(line.lstrip())
+        if requisite is not None and indent <= requisite[0]:
+            requisite = None
+        # an include, id or requisite rendered by jinja can't be matched to
+        # the sls it names, neither can whatever a top level expression
+        # renders into
+        if JINJA_RE.search(line) and (indent == 0 or requisite is not None or (in_include and line.lstrip().startswith("-"))):
+            entry["dynamic"] = True
+        include = INCLUDE_ITEM_RE.match(line) if in_include else None
+        if in_include and line.lstrip().startswith("-"):
+            if include:
+                entry["includes"].append(resolve(include.group(1), name, path))
+            continue
+        in_include = False
+        top_key = TOP_KEY_RE.match(line)
+        if top_key:
+            if top_key.group(1) == "include":
+                in_include = True
+            elif top_key.group(1) != "extend":
+                entry["ids"].append(top_key.group(1))
+            continue
+        match = REQUISITE_RE.match(line)
+        if match:
+            requisite = (indent, match.group(2) == "_in")
+            continue
+        match = REQUISITE_ITEM_RE.match(line)
+        if requisite is not None and match and not JINJA_RE.search(line):
+            # sls: requisites name an sls, everything else a state id
+            ref = f"sls:{resolve(match.group(2), name, path)}" if match.group(1) == "sls" else match.group(2)
+            entry["required_by" if requisite[1] else "requires"].append(ref)
+    for ref in SALT_URL_RE.findall(text) + JINJA_IMPORT_RE.findall(text):
+        ref = TEMPLATE_VAR_RE.sub(
+            lambda x: TEMPLATE_VARS[x.group(1)](name, path) if x.group(1) in TEMPLATE_VARS else x.group(0),
+            ref,
+        )
+        if "{{" in ref or "{%" in ref:
+            entry["dynamic"] = True
+        else:
+            entry["files"].append(ref.rstrip("/"))
+    return {k: sorted(set(v)) if isinstance(v, list) else v for k, v in entry.items()}
+
+
+class SlsIndex:
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        self.path = index_path(config)
+        cache = nacl.sync.load_manifest(self.path)
+        self.entries: dict[str, dict] = cache.get("index", {})
+        self.applied: dict[str, dict] = cache.get("applied", {})
+        self.files = nacl.fingerprint.formula_files(config)
+        self.update()
+
+    def update(self) -> None:
+        # only sls files whose hash moved since the last index are parsed again
+        formula_dir = f"{self.config['running_tmp_dir']}/formulas/{self.config['formula']}"
+        entries = {}
+        for rel_path, digest in self.files.items():
+            # pillar sls aren't states, a pillar change always applies everything
+            if not rel_path.endswith(".sls") or rel_path.startswith(f"nacl/{self.config['scenario']}/pillar/"):
+                continue
+            entry = self.entries.get(rel_path)
+            if entry is None or entry["hash"] != digest:
+                with open(f"{formula_dir}/{rel_path}", "r", errors="replace") as sls:
+                    entry = parse_sls(sls.read(), fileserver_path(self.config, rel_path))
+                entry["hash"] = digest
+            entries[rel_path] = entry
+        self.entries = entries
+
+    def save(self) -> None:
+        nacl.sync.write_manifest(self.path, {"index": self.entries, "applied": self.applied})
+
+    def record_applied(self, instance: dict) -> None:
+        self.applied[instance["prov_name"].split("_")[-1]] = {
+            "files": self.files,
+            "context": nacl.fingerprint.hash_data(nacl.fingerprint.apply_context(self.config, instance)),
+        }
+
+    def reachable(self, top: str) -> set[str]:
+        by_name = {x["sls"]: x for x in self.entries.values()}
+        seen: set[str] = set()
+        todo = [top]
+        while todo != []:
+            name = todo.pop()
+            if name in seen or name not in by_name:
+                continue
+            seen.add(name)
+            todo += by_name[name]["includes"] + [x[4:] for x in by_name[name]["requires"] if x.startswith("sls:")]
+        return seen
+
+    def owners(self) -> dict[str, str]:
+        # state id -> the sls that defines it
+        return {x: entry["sls"] for entry in self.entries.values() for x in entry["ids"]}
+
+    def dependents(self) -> dict[str, set[str]]:
+        # sls -> the sls that have to run again when it changes, an include
+        # alone doesn't make one sls watch another
+        owner = self.owners()
+        dependents: dict[str, set[str]] = {}
+        for entry in self.entries.values():
+            for ref in entry["requires"]:
+                name = ref[4:] if ref.startswith("sls:") else owner.get(ref)
+                if name is not None and name != entry["sls"]:
+                    dependents.setdefault(name, set()).add(entry["sls"])
+            for ref in entry["required_by"]:
+                name = ref[4:] if ref.startswith("sls:") else owner.get(ref)
+                if name is not None and name != entry["sls"]:
+                    dependents.setdefault(entry["sls"], set()).add(name)
+        return dependents
+
+    def changed_states(self, instance: dict, top: str) -> Optional[list[str]]:
+        # None means the change can't be narrowed down and top has to run
+        applied = self.applied.get(instance["prov_name"].split("_")[-1])
+        if applied is None or applied["context"] != nacl.fingerprint.hash_data(nacl.fingerprint.apply_context(self.config, instance)):
+            return None
+        by_name = {x["sls"]: x for x in self.entries.values()}
+        reachable = self.reachable(top)
+        # jinja decides the ids or sources of some sls, what they depend on
+        # and what depends on them isn't known
+        if any(by_name[x]["dynamic"] for x in reachable):
+            return None
+        changed = [
+            x for x in set(self.files) | set(applied["files"])
+            if self.files.get(x) != applied["files"].get(x)
+        ]
+        affected = set()
+        for rel_path in changed:
+            if rel_path.endswith(".sls"):
+                if rel_path not in self.entries:
+                    return None
+                affected.add(self.entries[rel_path]["sls"])
+                continue
+            path = fileserver_path(self.config, rel_path)
+            users = [
+                x["sls"] for x in self.entries.values()
+                if any(path == f or path.startswith(f"{f}/") for f in x["files"])
+            ]
+            if users == []:
+                return None
+            affected.update(users)
+        dependents = self.dependents()
+        todo = list(affected)
+        while todo != []:
+            for name in dependents.get(todo.pop(), set()):
+                if name not in affected:
+                    affected.add(name)
+                    todo.append(name)
+        # state.sls of a subset fails with "requisite not found" unless the
+        # sls defining every id it requires, watches or extends with _in
+        # runs along
+        owner = self.owners()
+        todo = list(affected)
+        while todo != []:
+            entry = by_name.get(todo.pop())
+            if entry is None:
+                continue
+            for ref in entry["requires"] + entry["required_by"]:
+                sls = ref[4:] if ref.startswith("sls:") else owner.get(ref)
+                if sls is None:
+                    return None
+                if sls not in affected:
+                    affected.add(sls)
+                    todo.append(sls)
+        if top in affected or top not in reachable:
+            return [top]
+        return sorted(affected & reachable)
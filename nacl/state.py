@@ -0,0 +1,160 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+import nacl.config
+
+CREATED = "Created"
+PREPARED = "Prepared"
+CONVERGED = "Converged"
+NOT_CREATED = "Not created"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS instances (
+    formula TEXT NOT NULL,
+    scenario TEXT NOT NULL,
+    name TEXT NOT NULL,
+    provider TEXT NOT NULL,
+    state TEXT NOT NULL,
+    base TEXT,
+    formula_hash TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (formula, scenario, name)
+);
+CREATE TABLE IF NOT EXISTS history (
+    formula TEXT NOT NULL,
+    scenario TEXT NOT NULL,
+    name TEXT NOT NULL,
+    state TEXT NOT NULL,
+    at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS verify_cache (
+    formula TEXT NOT NULL,
+    scenario TEXT NOT NULL,
+    name TEXT NOT NULL,
+    tests TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    at REAL NOT NULL,
+    PRIMARY KEY (formula, scenario, name, tests)
+);
+"""
+
+
+def short_name(instance: dict) -> str:
+    return instance["prov_name"].split("_")[-1]
+
+
+class StateStore:
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path or f"{nacl.config.TMP_DIR}state.db"
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.connect() as conn:
+            conn.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        # scenarios run in parallel processes, so every call gets its own
+        # short lived connection and waits on the write lock if it has to
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, config: dict) -> dict[str, dict]:
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT * FROM instances WHERE formula = ? AND scenario = ?",
+                (config["formula"], config["scenario"]),
+            ).fetchall()
+        return {x["name"]: dict(x) for x in rows}
+
+    def state(self, config: dict, instance: dict) -> str:
+        return self.get(config).get(short_name(instance), {}).get("state", NOT_CREATED)
+
+    def set_state(
+        self, config: dict, instance: dict, state: str, formula_hash: Optional[str] = None
+    ) -> None:
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO instances (formula, scenario, name, provider, state, base, formula_hash, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (formula, scenario, name) DO UPDATE SET
+                    state = excluded.state,
+                    base = excluded.base,
+                    formula_hash = COALESCE(excluded.formula_hash, instances.formula_hash),
+                    updated_at = excluded.updated_at
+                """,
+                (
+                    config["formula"],
+                    config["scenario"],
+                    short_name(instance),
+                    config["provider"]["name"],
+                    state,
+                    instance.get("image", instance.get("box")),
+                    formula_hash,
+                    now,
+                    now,
+                ),
+            )
+            conn.execute(
+                "INSERT INTO history (formula, scenario, name, state, at) VALUES (?, ?, ?, ?, ?)",
+                (config["formula"], config["scenario"], short_name(instance), state, now),
+            )
+
+    def remove(self, config: dict, name: str) -> None:
+        with self.connect() as conn:
+            conn.execute(
+                "DELETE FROM instances WHERE formula = ? AND scenario = ? AND name = ?",
+                (config["formula"], config["scenario"], name),
+            )
+            conn.execute(
+                "INSERT INTO history (formula, scenario, name, state, at) VALUES (?, ?, ?, ?, ?)",
+                (config["formula"], config["scenario"], name, NOT_CREATED, time.time()),
+            )
+
+    def verified(self, config: dict, name: str, tests: str) -> Optional[str]:
+        with self.connect() as conn:
+            row = conn.execute(
+                "SELECT fingerprint FROM verify_cache WHERE formula = ? AND scenario = ? AND name = ? AND tests = ?",
+                (config["formula"], config["scenario"], name, tests),
+            ).fetchone()
+        return row["fingerprint"] if row else None
+
+    def set_verified(self, config: dict, name: str, tests: str, fingerprint: str) -> None:
+        with self.connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO verify_cache (formula, scenario, name, tests, fingerprint, at)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (formula, scenario, name, tests) DO UPDATE SET
+                    fingerprint = excluded.fingerprint,
+                    at = excluded.at
+                """,
+                (config["formula"], config["scenario"], name, tests, fingerprint, time.time()),
+            )
+
+    def remove_scenario(self, config: dict) -> None:
+        for name in self.get(config):
+            self.remove(config, name)
+
+    def reconcile(self, config: dict, inventory: list[tuple[str, str]]) -> None:
+        instances = {short_name(x): x for x in config["instances"]}
+        known = self.get(config)
+        for name, status in inventory:
+            if status == NOT_CREATED:
+                if name in known:
+                    self.remove(config, name)
+                continue
+            # backends report their own statuses (running, poweroff, ...),
+            # anything nacl hasn't prepared or converged is just created
+            state = status if status in (PREPARED, CONVERGED) else CREATED
+            if name not in known or known[name]["state"] != state:
+                self.set_state(config, instances.get(name, {"prov_name": name}), state)
@@ -0,0 +1,181 @@
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+from dataclasses import dataclass, field
+
+IGNORE_FILE = ".naclignore"
+
+DEFAULT_IGNORE = [
+    ".git/",
+    ".venv/",
+    "venv/",
+    ".tox/",
+    ".nox/",
+    "__pycache__/",
+    ".pytest_cache/",
+    ".mypy_cache/",
+    "*.pyc",
+]
+
+LINK_MODES = ["copy", "reflink", "hardlink"]
+
+# FICLONE from linux/fs.h, clones a file's extents on btrfs/xfs/overlayfs
+FICLONE = 0x40049409
+
+
+@dataclass
+class SyncResult:
+    added: list[str] = field(default_factory=list)
+    changed: list[str] = field(default_factory=list)
+    removed: list[str] = field(default_factory=list)
+
+    @property
+    def updated(self) -> list[str]:
+        return self.added + self.changed
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.changed or self.removed)
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_ignore(src: str) -> list[str]:
+    patterns = list(DEFAULT_IGNORE)
+    if os.path.exists(f"{src}/{IGNORE_FILE}"):
+        with open(f"{src}/{IGNORE_FILE}", "r") as ignore:
+            for line in ignore.readlines():
+                line = line.strip()
+                if line != "" and not line.startswith("#"):
+                    patterns.append(line)
+    return patterns
+
+
+def is_ignored(rel_path: str, is_dir: bool, patterns: list[str]) -> bool:
+    name = os.path.basename(rel_path)
+    for pattern in patterns:
+        if pattern.endswith("/"):
+            if not is_dir:
+                continue
+            pattern = pattern.rstrip("/")
+        pattern = pattern.lstrip("/")
+        if fnmatch.fnmatch(rel_path, pattern) or fnmatch.fnmatch(name, pattern):
+            return True
+    return False
+
+
+def scan_tree(src: str, patterns: list[str]) -> dict[str, os.stat_result]:
+    files = {}
+    # linked directories are followed, each real directory only once so a
+    # symlink cycle can't send the walk round forever
+    visited = set()
+    for root, dirs, filenames in os.walk(src, followlinks=True):
+        stat = os.stat(root)
+        if (stat.st_dev, stat.st_ino) in visited:
+            dirs[:] = []
+            continue
+        visited.add((stat.st_dev, stat.st_ino))
+        rel_root = os.path.relpath(root, src)
+        rel_root = "" if rel_root == "." else f"{rel_root}/"
+        dirs[:] = [x for x in dirs if not is_ignored(f"{rel_root}{x}", True, patterns)]
+        for name in filenames:
+            rel_path = f"{rel_root}{name}"
+            if not is_ignored(rel_path, False, patterns):
+                files[rel_path] = os.stat(f"{root}/{name}")
+    return files
+
+
+def load_manifest(path: str) -> dict[str, dict]:
+    try:
+        with open(path, "r") as manifest:
+            return json.load(manifest)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def write_manifest(path: str, manifest: dict[str, dict]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifest, f)
+    os.replace(f"{path}.tmp", path)
+
+
+def place_file(src: str, dst: str, link_mode: str) -> None:
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if link_mode == "hardlink":
+        try:
+            os.link(src, dst)
+            return
+        except OSError:
+            pass
+    elif link_mode == "reflink":
+        try:
+            import fcntl
+
+            with open(src, "rb") as s, open(dst, "wb") as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            shutil.copystat(src, dst)
+            return
+        except (OSError, ImportError):
+            if os.path.exists(dst):
+                os.unlink(dst)
+    shutil.copy2(src, dst)
+
+
+def sync_tree(
+    src: str, dst: str, manifest_path: str, link_mode: str = "reflink"
+) -> SyncResult:
+    src = os.path.normpath(src)
+    dst = os.path.normpath(dst)
+    result = SyncResult()
+    patterns = load_ignore(src)
+    # a destination without a manifest was made some other way, start over
+    if not os.path.exists(dst):
+        old_manifest = {}
+    else:
+        old_manifest = load_manifest(manifest_path)
+        if old_manifest == {}:
+            shutil.rmtree(dst)
+    os.makedirs(dst, exist_ok=True)
+    manifest = {}
+    for rel_path, stat in scan_tree(src, patterns).items():
+        entry: dict = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        old_entry = old_manifest.get(rel_path)
+        target = f"{dst}/{rel_path}"
+        if (
+            old_entry is not None
+            and old_entry["size"] == entry["size"]
+            and old_entry["mtime_ns"] == entry["mtime_ns"]
+            and os.path.exists(target)
+        ):
+            manifest[rel_path] = old_entry
+            continue
+        entry["hash"] = file_digest(f"{src}/{rel_path}")
+        manifest[rel_path] = entry
+        if old_entry is not None and old_entry.get("hash") == entry["hash"] and os.path.exists(target):
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        place_file(f"{src}/{rel_path}", target, link_mode)
+        if old_entry is None:
+            result.added.append(rel_path)
+        else:
+            result.changed.append(rel_path)
+    for rel_path in sorted(old_manifest.keys() - manifest.keys()):
+        target = f"{dst}/{rel_path}"
+        if os.path.lexists(target):
+            os.unlink(target)
+        result.removed.append(rel_path)
+        parent = os.path.dirname(target)
+        while parent != dst and os.path.isdir(parent) and os.listdir(parent) == []:
+            os.rmdir(parent)
+            parent = os.path.dirname(parent)
+    write_manifest(manifest_path, manifest)
+    return result
@@ -0,0 +1,76 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.enabled = False
+        self.events: list[dict] = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, cat: str = "phase", **args):
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            # chrome trace "complete" events, timestamps in microseconds
+            event = {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "ts": int(start * 1_000_000),
+                "dur": int((end - start) * 1_000_000),
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+            with self.lock:
+                self.events.append(event)
+
+    def write(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as trace:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, trace)
+
+    def summary(self) -> list[tuple[str, str, int, float, float]]:
+        totals: dict[tuple[str, str], list[float]] = {}
+        for event in self.events:
+            totals.setdefault((event["cat"], event["name"]), []).append(event["dur"] / 1_000_000)
+        return sorted(
+            [(cat, name, len(x), sum(x), max(x)) for (cat, name), x in totals.items()],
+            key=lambda x: (x[0] != "phase", -x[3]),
+        )
+
+
+TRACER = Tracer()
+
+
+def span(name: str, cat: str = "phase", **args):
+    return TRACER.span(name, cat, **args)
+
+
+def traced(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with TRACER.span(f"{type(self).__name__}.{func.__name__}", "orchestrator"):
+            return func(self, *args, **kwargs)
+
+    return wrapper
+
+
+def print_summary(path: str) -> None:
+    print(f"> Timings (trace written to {path})")
+    rows = TRACER.summary()
+    width = max([len("Name")] + [len(x[1]) for x in rows])
+    print("Category".ljust(12), "Name".ljust(width), "Count".rjust(6), "Total".rjust(10), "Max".rjust(10))
+    for cat, name, count, total, longest in rows:
+        print(cat.ljust(12), name.ljust(width), str(count).rjust(6), f"{total:.2f}s".rjust(10), f"{longest:.2f}s".rjust(10))
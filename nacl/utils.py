@@ -1,8 +1,12 @@
 import os
-import shutil
+import subprocess
+import time
+from typing import Callable
 
+import nacl.sync
+import nacl.timings
 import nacl.templates
-from nacl.exceptions import ScenarioExists
+from nacl.exceptions import OrchestrationTimeout, ScenarioExists
 
 
 def create_tmp_dir(tmp_dir):
@@ -10,14 +14,43 @@ def create_tmp_dir(tmp_dir):
         os.makedirs(tmp_dir)
 
 
-def copy_srv_dir(tmp_dir: str, formula: str, formula_path: str) -> None:
-    if not os.path.exists(tmp_dir):
-        os.mkdir(tmp_dir)
+def wait_for(
+    check: Callable[[], bool],
+    message: str,
+    timeout: float = 300,
+    delay: float = 0.2,
+    max_delay: float = 2.0,
+) -> None:
+    deadline = time.monotonic() + timeout
+    while not check():
+        if time.monotonic() >= deadline:
+            raise OrchestrationTimeout(f"Timed out after {timeout}s waiting for {message}")
+        time.sleep(min(delay, max(0, deadline - time.monotonic())))
+        delay = min(delay * 2, max_delay)
+
+
+def stream_process(cmd: str, output: Callable[[bytes], None], **kwargs) -> int:
+    with nacl.timings.span(cmd.split(" ")[0], "subprocess", cmd=cmd):
+        proc = subprocess.Popen(
+            cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs
+        )
+        assert proc.stdout is not None
+        for line in proc.stdout:
+            output(line)
+        return proc.wait()
+
+
+def copy_srv_dir(
+    tmp_dir: str, formula: str, formula_path: str, link_mode: str = "reflink"
+) -> nacl.sync.SyncResult:
     if not os.path.exists(f"/{tmp_dir}/formulas/"):
-        os.mkdir(f"/{tmp_dir}/formulas")
-    if os.path.exists(f"/{tmp_dir}/formulas/{formula}"):
-        shutil.rmtree(f"/{tmp_dir}/formulas/{formula}")
-    shutil.copytree(formula_path, f"/{tmp_dir}/formulas/{formula}")
+        os.makedirs(f"/{tmp_dir}/formulas")
+    return nacl.sync.sync_tree(
+        formula_path,
+        f"/{tmp_dir}/formulas/{formula}",
+        f"/{tmp_dir}/manifests/{formula}.json",
+        link_mode,
+    )
 
 
 def init_state(state: str, force=False):
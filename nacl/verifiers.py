@@ -1,6 +1,49 @@
+import concurrent.futures
+import os
+import shutil
 import subprocess
-import sys
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from typing import Optional
+import nacl.apply
+import nacl.fingerprint
 import nacl.orchestrators
+import nacl.state
+import nacl.sync
+import nacl.timings
+
+
+@dataclass
+class VerifyRun:
+    host: str
+    tests: str
+    returncode: int
+    log_file: str
+    cached: bool = False
+
+
+@dataclass
+class VerifyResult:
+    runs: list[VerifyRun] = field(default_factory=list)
+    junit_file: str = ""
+
+    @property
+    def passed(self) -> bool:
+        return self.failed == []
+
+    @property
+    def failed(self) -> list[VerifyRun]:
+        # pytest exits 5 when the selection has no tests, nothing failed
+        return [x for x in self.runs if x.returncode not in (0, 5)]
+
+
+# files next to the tests that pytest reads from the scenario dir, its rootdir
+PYTEST_FILES = ["conftest.py", "pytest.ini", "pyproject.toml", "setup.cfg", "tox.ini"]
+
+
+def is_test_file(name: str) -> bool:
+    name = os.path.basename(name)
+    return name.endswith(".py") and (name.startswith("test_") or name.endswith("_test.py"))
 
 
 class Verifier:
@@ -10,8 +53,25 @@ class Verifier:
         self.config = config
         self.scenario_dir = orchestrator.scenario_dir
 
-    def run(self) -> None:
-        pass
+    def run(self, use_cache: bool = True) -> VerifyResult:
+        return VerifyResult()
+
+
+def merge_junit(files: list[str], path: str) -> None:
+    merged = ET.Element("testsuites")
+    totals = {"tests": 0, "failures": 0, "errors": 0, "skipped": 0}
+    for junit_file in files:
+        try:
+            root = ET.parse(junit_file).getroot()
+        except (OSError, ET.ParseError):
+            continue
+        for suite in [root] if root.tag == "testsuite" else root.iter("testsuite"):
+            for key in totals:
+                totals[key] += int(suite.get(key, 0))
+            merged.append(suite)
+    for key, value in totals.items():
+        merged.set(key, str(value))
+    ET.ElementTree(merged).write(path, encoding="utf-8", xml_declaration=True)
 
 
 class Testinfra(Verifier):
@@ -19,19 +79,98 @@ class Testinfra(Verifier):
         self, config: dict, orchestrator: nacl.orchestrators.Orchestrator
     ) -> None:
         super().__init__(config, orchestrator)
-        match orchestrator:
-            case nacl.orchestrators.Vagrant():
-                self.inventory = [f"ssh://{x[0]}" for x in orchestrator.get_inventory()]
-                self.extra_options = "--ssh-config={self.scenario_dir}/ssh_config"
-            case nacl.orchestrators.Docker():
-                self.inventory = [f"docker://nacl_{self.config['formula']}_{self.config['scenario']}_{x[0]}" for x in orchestrator.get_inventory()]
+        prefix = f"nacl_{self.config['formula']}_{self.config['scenario']}"
+        match orchestrator.connection_type:
+            case "ssh":
+                self.inventory = [f"ssh://{prefix}_{x[0]}" for x in orchestrator.get_inventory()]
+                self.extra_options = f"--ssh-config={self.scenario_dir}/ssh_config"
+            case "docker":
+                self.inventory = [f"docker://{prefix}_{x[0]}" for x in orchestrator.get_inventory()]
                 self.extra_options = ""
+        # pytest runs from the scenario dir so its conftest.py and config
+        # still apply, the tests are passed relative to it
+        self.scenario_path = f"{self.config['running_tmp_dir']}/formulas/{self.config['formula']}/nacl/{self.config['scenario']}"
+        self.tests_dir = f"{self.scenario_path}/tests"
 
-    def run(self) -> None:
-        proc = subprocess.run(
-            f'python -m pytest {self.extra_options} --hosts={",".join(self.inventory)} tests/',
-            shell=True,
-            cwd=f"{self.config['running_tmp_dir']}/formulas/{self.config['formula']}/nacl/{self.config['scenario']}",
+    def test_files(self) -> list[str]:
+        files = sorted(
+            f"tests/{x}"
+            for x in nacl.sync.scan_tree(self.tests_dir, nacl.sync.DEFAULT_IGNORE)
+            if is_test_file(x)
+        ) if os.path.isdir(self.tests_dir) else []
+        return files or ["tests"]
+
+    def fingerprint(self, row: Optional[dict], tests: str) -> Optional[str]:
+        # only instances converged by nacl have a known applied state
+        if row is None or row["state"] != nacl.state.CONVERGED or not row["formula_hash"]:
+            return None
+        shared = {x: nacl.fingerprint.hash_tree(f"{self.scenario_path}/{x}") for x in PYTEST_FILES}
+        if tests == "tests":
+            tests_hash = nacl.fingerprint.hash_data({"tests": nacl.fingerprint.hash_tree(self.tests_dir), **shared})
+        else:
+            # conftest.py and helper modules are shared by every test file
+            tests_hash = nacl.fingerprint.hash_data(
+                {
+                    **{
+                        f"tests/{x}": nacl.sync.file_digest(f"{self.tests_dir}/{x}")
+                        for x in nacl.sync.scan_tree(self.tests_dir, nacl.sync.DEFAULT_IGNORE)
+                        if f"tests/{x}" == tests or not is_test_file(x)
+                    },
+                    **shared,
+                }
+            )
+        return nacl.fingerprint.hash_data(
+            {
+                "tests": tests_hash,
+                "applied": row["formula_hash"],
+                # not the machine itself, a recreated instance converged to
+                # the same fingerprint is tested against the same state
+                "instance": [row["name"], row["provider"], row["base"]],
+            }
         )
-        if proc.returncode != 0:
-            sys.exit(proc.returncode)
+
+    def run_one(self, host: str, tests: str, junit_dir: str) -> VerifyRun:
+        unit = os.path.splitext(tests)[0][len("tests/"):].replace("/", "-")
+        name = f"{host.split('_')[-1]}-{unit or 'all'}"
+        log_file = f"{nacl.apply.log_dir(self.config)}/verify-{name}.log"
+        with nacl.timings.span(f"pytest {name}", "subprocess"), open(log_file, "wb") as log:
+            proc = subprocess.run(
+                f"python -m pytest {self.extra_options} --hosts={host} --junitxml={junit_dir}/{name}.xml {tests}",
+                shell=True,
+                cwd=self.scenario_path,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+        return VerifyRun(host.split("_")[-1], tests, proc.returncode, log_file)
+
+    def run(self, use_cache: bool = True) -> VerifyResult:
+        # every host x test file is its own pytest process, testinfra
+        # otherwise walks the hosts one after the other
+        junit_dir = f"{self.scenario_dir}junit"
+        if os.path.exists(junit_dir):
+            shutil.rmtree(junit_dir)
+        os.makedirs(junit_dir)
+        store = nacl.state.StateStore()
+        known = store.get(self.config)
+        result = VerifyResult(junit_file=f"{self.scenario_dir}junit.xml")
+        units = []
+        for host in self.inventory:
+            for tests in self.test_files():
+                fingerprint = self.fingerprint(known.get(host.split("_")[-1]), tests)
+                if use_cache and fingerprint and store.verified(self.config, host.split("_")[-1], tests) == fingerprint:
+                    print(f"==> verify {tests} on {host.split('_')[-1]}: passed (cached)")
+                    result.runs.append(VerifyRun(host.split("_")[-1], tests, 0, "", cached=True))
+                else:
+                    units.append((host, tests, fingerprint))
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, self.config.get("verify_parallelism", os.cpu_count() or 1))
+        ) as pool:
+            futures = [(pool.submit(self.run_one, host, tests, junit_dir), fingerprint) for host, tests, fingerprint in units]
+            for future, fingerprint in futures:
+                run = future.result()
+                print(f"==> verify {run.tests} on {run.host}: {'passed' if run.returncode in (0, 5) else 'failed'}")
+                if run.returncode == 0 and fingerprint:
+                    store.set_verified(self.config, run.host, run.tests, fingerprint)
+                result.runs.append(run)
+        merge_junit(sorted(f"{junit_dir}/{x}" for x in os.listdir(junit_dir) if x.endswith(".xml")), result.junit_file)
+        return result
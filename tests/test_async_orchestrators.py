@@ -0,0 +1,228 @@
+import asyncio
+import json
+import os
+import threading
+import urllib.parse
+
+import nacl.async_orchestrators
+import nacl.config
+import nacl.state
+
+
+def frame(stream: int, data: bytes) -> bytes:
+    return bytes([stream, 0, 0, 0]) + len(data).to_bytes(4, "big") + data
+
+
+class FakeEngine:
+    # just enough of the engine API for exec, orchestrate and cleanup
+    def __init__(self) -> None:
+        self.images = set()
+        self.containers: dict[str, dict] = {}
+        self.execs: dict[str, list[str]] = {}
+        self.calls: list[str] = []
+        self.commits: list[dict] = []
+
+    def reply(self, writer: asyncio.StreamWriter, status: str, data=None) -> None:
+        body = json.dumps(data).encode() if data is not None else b""
+        writer.write(b"HTTP/1.1 %s\r\nContent-Length: %d\r\n\r\n%s" % (status.encode(), len(body), body))
+
+    def exec_output(self, cmd: list[str]) -> tuple[bytes, bytes]:
+        if cmd[0] == "salt-key":
+            return json.dumps({"minions": [x.split("_")[-1] for x in self.containers if not x.endswith("_master")]}).encode(), b""
+        if cmd[0] == "salt-run":
+            return b"- base\n", b""
+        return b"local:\n  Tr", b"warning\n"
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        method, target, _ = (await reader.readline()).decode().split(" ")
+        length = 0
+        while (line := await reader.readline()) != b"\r\n":
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":")[1])
+        body = json.loads(await reader.readexactly(length)) if length else None
+        url = urllib.parse.urlsplit(target)
+        path = url.path[len("/v1.41"):]
+        query = dict(urllib.parse.parse_qsl(url.query))
+        self.calls.append(f"{method} {path}")
+        if path == "/containers/json":
+            self.reply(writer, "200 OK", [
+                {"Id": k, "Names": [f"/{k}"], "State": "running", "Labels": v["Labels"]} for k, v in self.containers.items()
+            ])
+        elif path == "/networks":
+            self.reply(writer, "200 OK", [])
+        elif path == "/networks/create":
+            self.reply(writer, "201 Created", {"Id": "n1"})
+        elif path == "/containers/create":
+            if body["Image"] not in self.images:
+                self.reply(writer, "404 Not Found", {"message": f"No such image: {body['Image']}"})
+            else:
+                name = query.get("name", f"scratch{len(self.containers)}")
+                self.containers[name] = body
+                self.reply(writer, "201 Created", {"Id": name})
+        elif path == "/images/create":
+            self.images.add(f"{query['fromImage']}:{query['tag']}")
+            progress = b'{"status": "Pulling"}\r\n{"status": "Downloaded"}\r\n'
+            writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n")
+            writer.write(b"%x\r\n%s\r\n0\r\n\r\n" % (len(progress), progress))
+        elif path == "/commit":
+            image = f"{query['repo']}:{query['tag']}" if "repo" in query else f"snapshot{len(self.commits)}"
+            self.images.add(image)
+            self.commits.append(query)
+            self.reply(writer, "201 Created", {"Id": image})
+        elif path.startswith("/images/") and path.endswith("/json"):
+            if path.split("/")[2] in self.images:
+                self.reply(writer, "200 OK", {"Config": {"Entrypoint": None, "Cmd": ["salt-minion"]}})
+            else:
+                self.reply(writer, "404 Not Found", {"message": "No such image"})
+        elif path.endswith("/wait"):
+            self.reply(writer, "200 OK", {"StatusCode": 0})
+        elif path.endswith("/exec"):
+            self.execs[f"e{len(self.execs)}"] = body["Cmd"]
+            self.reply(writer, "201 Created", {"Id": f"e{len(self.execs) - 1}"})
+        elif path.startswith("/exec/") and path.endswith("/start"):
+            out, err = self.exec_output(self.execs[path.split("/")[2]])
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: application/vnd.docker.multiplexed-stream\r\n\r\n")
+            writer.write(frame(1, out) + (frame(2, err) if err else b""))
+            await writer.drain()
+            if out.endswith(b"Tr"):
+                writer.write(frame(1, b"ue\n"))
+        elif path.startswith("/exec/"):
+            self.reply(writer, "200 OK", {"Running": False, "ExitCode": 3 if self.execs[path.split("/")[2]][0] == "salt-call" else 0})
+        elif method == "DELETE" and path.startswith("/containers/"):
+            del self.containers[path.split("/")[2]]
+            self.reply(writer, "204 No Content")
+        else:
+            self.reply(writer, "204 No Content")
+        await writer.drain()
+        writer.close()
+
+
+def start_engine(tmp_path, monkeypatch) -> FakeEngine:
+    engine = FakeEngine()
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_unix_server(engine.handle, f"{tmp_path}/docker.sock"))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("DOCKER_HOST", f"unix://{tmp_path}/docker.sock")
+    monkeypatch.setattr(nacl.config, "TMP_DIR", f"{tmp_path}/nacl/")
+    engine.stop = lambda: (loop.call_soon_threadsafe(server.close), loop.call_soon_threadsafe(loop.stop), thread.join())
+    return engine
+
+
+def test_async_docker_exec(tmp_path, monkeypatch) -> None:
+    engine = start_engine(tmp_path, monkeypatch)
+    config = {"formula": "f", "scenario": "default", "running_tmp_dir": f"{tmp_path}/", "instances": []}
+    orch = nacl.async_orchestrators.SyncAdapter(nacl.async_orchestrators.AsyncDocker(config))
+    try:
+        lines = []
+        proc = orch.exec("nacl_f_default_box1", "salt-call test.ping", output=lines.append)
+        assert proc.returncode == 3
+        assert sorted(lines) == [b"  True\n", b"local:\n", b"warning\n"]
+        proc = orch.exec("nacl_f_default_box1", "salt-call test.ping")
+        assert (proc.stdout, proc.stderr) == (b"local:\n  True\n", b"warning\n")
+        assert orch.master_name == "nacl_f_default_master"
+        assert orch.connection_type == "docker"
+    finally:
+        engine.stop()
+
+
+def test_async_docker_orchestrate(tmp_path, monkeypatch) -> None:
+    engine = start_engine(tmp_path, monkeypatch)
+    config = {
+        "formula": "f",
+        "scenario": "default",
+        "running_tmp_dir": f"{tmp_path}/",
+        "provider": {"name": "docker"},
+        "master_config": {},
+        "instances": [{"prov_name": "nacl_f_default_box1", "image": "centos:9"}],
+    }
+    orch = nacl.async_orchestrators.SyncAdapter(nacl.async_orchestrators.AsyncDocker(config))
+    try:
+        # neither image is local, both are pulled before their container is created
+        assert orch.orchestrate() == {"box1": nacl.state.CREATED}
+        assert engine.images == {"salt:3006", "centos:9"}
+        assert sorted(engine.containers) == ["nacl_f_default_box1", "nacl_f_default_master"]
+        assert os.path.exists(f"{orch.scenario_dir}/nacl_f_default_box1_minion")
+        assert engine.containers["nacl_f_default_box1"]["HostConfig"]["Binds"] == [
+            f"{orch.scenario_dir}/nacl_f_default_box1_minion:/etc/salt/minion:z"
+        ]
+        assert engine.containers["nacl_f_default_box1"]["HostConfig"]["Tmpfs"] == {"/tmp": "", "/run": ""}
+        assert orch.get_inventory() == [("box1", "Created")]
+
+        orch.cleanup()
+        assert engine.containers == {}
+        assert "DELETE /networks/nacl_f_default" in engine.calls
+        assert not os.path.exists(orch.scenario_dir)
+        # the adapter gets a new loop after cleanup closed its own
+        assert orch.get_inventory() == [("box1", "Not created")]
+    finally:
+        engine.stop()
+
+
+def test_async_docker_commit_prepared(tmp_path, monkeypatch) -> None:
+    engine = start_engine(tmp_path, monkeypatch)
+    config = {
+        "formula": "f",
+        "scenario": "default",
+        "running_tmp_dir": f"{tmp_path}/",
+        "provider": {"name": "docker"},
+        "master_config": {},
+        "image_cache": True,
+        "instances": [{"prov_name": "nacl_f_default_box1", "image": "centos:9"}],
+    }
+    orch = nacl.async_orchestrators.SyncAdapter(nacl.async_orchestrators.AsyncDocker(config))
+    try:
+        orch.orchestrate()
+        orch.commit_prepared(config["instances"][0])
+        repository, tag = orch.prepared_image(config["instances"][0]).split(":")
+        # the live minion keeps its key, it is dropped in a throwaway copy
+        assert [x for x in engine.execs.values() if x[0] == "rm"] == []
+        assert engine.commits[0] == {"container": "nacl_f_default_box1"}
+        assert engine.commits[1]["repo"] == repository and engine.commits[1]["tag"] == tag
+        assert engine.commits[1]["changes"] == 'ENTRYPOINT []\nCMD ["salt-minion"]'
+        assert sorted(engine.containers) == ["nacl_f_default_box1", "nacl_f_default_master"]
+    finally:
+        engine.stop()
+
+
+FAKE_VAGRANT = """#!/bin/sh
+if [ "$1" = "status" ]; then
+    echo "1700000000,nacl_f_default_box1,metadata,provider,virtualbox"
+    echo "1700000000,nacl_f_default_box1,state,running"
+    echo "1700000000,nacl_f_default_box1,state-human-short,running"
+    echo "1700000000,nacl_f_default_box2,state,not_created"
+    echo "1700000000,,ui,info,Current machine states:"
+else
+    # a box download redraws its progress without ever ending the line
+    head -c 200000 /dev/zero | tr '\\0' '#'
+    printf '\\rdone\\n'
+fi
+"""
+
+
+def test_async_vagrant(tmp_path, monkeypatch) -> None:
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "bin" / "vagrant").write_text(FAKE_VAGRANT)
+    os.chmod(tmp_path / "bin" / "vagrant", 0o755)
+    monkeypatch.setenv("PATH", f"{tmp_path}/bin:{os.environ['PATH']}")
+    monkeypatch.setenv("VAGRANT_HOME", f"{tmp_path}/home")
+    monkeypatch.setattr(nacl.config, "TMP_DIR", f"{tmp_path}/nacl/")
+    config = {
+        "formula": "f",
+        "scenario": "default",
+        "running_tmp_dir": f"{tmp_path}/",
+        "provider": {"name": "vagrant"},
+        "instances": [
+            {"prov_name": "nacl_f_default_box1", "box": "centos"},
+            {"prov_name": "nacl_f_default_box2", "box": "centos"},
+        ],
+    }
+    orch = nacl.async_orchestrators.SyncAdapter(nacl.async_orchestrators.AsyncVagrant(config))
+    os.makedirs(orch.scenario_dir)
+    open(f"{orch.scenario_dir}/Vagrantfile", "w").close()
+    assert orch.get_inventory() == [("box1", "running"), ("box2", "Not created")]
+
+    lines = []
+    returncode, _ = orch.run("run_vagrant", "up", "nacl_f_default_box1", output=lines.append)
+    assert returncode == 0
+    assert len(lines) == 1 and lines[0].endswith(b"#\rdone\n")
@@ -25,6 +25,13 @@ def test_validate_config() -> None:
     with pytest.raises(nacl.exceptions.ConfigException):
         validate_config(broken_confg)
 
+    broken_confg = copy.deepcopy(test_conf)
+    broken_confg["provider"]["up_parallelism"] = 0
+    with pytest.raises(nacl.exceptions.ConfigException):
+        validate_config(broken_confg)
+    broken_confg["provider"]["up_parallelism"] = 2
+    validate_config(broken_confg)
+
 #These are currently tested against the Vagrant provider
 def test_generate_instance_config() -> None:
     test_conf = load_test_config("tests/data/test_confs/test1.yml")
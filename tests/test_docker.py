@@ -0,0 +1,106 @@
+import asyncio
+import json
+import threading
+import types
+
+import pytest
+
+import nacl.orchestrators
+from nacl.exceptions import OrchestrationTimeout
+
+
+class HungEngine:
+    # an engine whose exec writes one frame and then never ends the stream
+    def __init__(self) -> None:
+        self.released = asyncio.Event()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        method, target, _ = (await reader.readline()).decode().split(" ")
+        while await reader.readline() != b"\r\n":
+            pass
+        if target.endswith("/exec"):
+            body = json.dumps({"Id": "e0"}).encode()
+            writer.write(b"HTTP/1.1 201 Created\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+        elif target.endswith("/start"):
+            writer.write(b"HTTP/1.1 101 UPGRADED\r\nContent-Type: application/vnd.docker.raw-stream\r\nConnection: Upgrade\r\nUpgrade: tcp\r\n\r\n")
+            await writer.drain()
+            await asyncio.sleep(0.1)
+            writer.write(bytes([1, 0, 0, 0, 0, 0, 0, 6]) + b"hello\n")
+            await writer.drain()
+            # the client shutting its end down is all that ends this
+            await reader.read()
+            self.released.set()
+        else:
+            body = json.dumps({"ApiVersion": "1.41"}).encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+        await writer.drain()
+        writer.close()
+
+
+def test_docker_exec_timeout(tmp_path, monkeypatch) -> None:
+    engine = HungEngine()
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_unix_server(engine.handle, f"{tmp_path}/docker.sock"))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv("DOCKER_HOST", f"unix://{tmp_path}/docker.sock")
+    config = {"formula": "f", "scenario": "default", "running_tmp_dir": f"{tmp_path}/", "instances": []}
+    try:
+        orch = nacl.orchestrators.Docker(config)
+        lines = []
+        with pytest.raises(OrchestrationTimeout):
+            orch.exec("nacl_f_default_box1", "salt-call test.ping", output=lines.append, timeout=0.5)
+        assert lines == [b"hello\n"]
+        assert asyncio.run_coroutine_threadsafe(asyncio.wait_for(engine.released.wait(), 5), loop).result()
+    finally:
+        loop.call_soon_threadsafe(server.close)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+
+
+class FakeContainer:
+    def __init__(self, client, image: str, command=None, entrypoint=None) -> None:
+        self.client = client
+        self.image = image
+        self.command = command
+        self.entrypoint = entrypoint
+
+    def exec_run(self, cmd: str) -> None:
+        self.client.calls.append(("exec_run", cmd))
+
+    def commit(self, repository=None, tag=None, changes=None) -> types.SimpleNamespace:
+        self.client.calls.append(("commit", self.image, repository, tag, changes))
+        return types.SimpleNamespace(id="snapshot", attrs={"Config": {"Entrypoint": None, "Cmd": ["salt-minion"]}})
+
+    def wait(self) -> None:
+        self.client.calls.append(("wait", self.command))
+
+    def remove(self, force=False) -> None:
+        self.client.calls.append(("remove", self.image))
+
+
+def test_docker_commit_prepared(tmp_path) -> None:
+    client = types.SimpleNamespace(calls=[])
+    client.containers = types.SimpleNamespace(run=lambda image, command, entrypoint, detach: FakeContainer(client, image, command, entrypoint))
+    client.images = types.SimpleNamespace(remove=lambda image: client.calls.append(("remove_image", image)))
+    config = {
+        "formula": "f",
+        "scenario": "default",
+        "running_tmp_dir": f"{tmp_path}/",
+        "image_cache": True,
+        "instances": [{"prov_name": "nacl_f_default_box1", "image": "centos"}],
+    }
+    orch = nacl.orchestrators.Docker.__new__(nacl.orchestrators.Docker)
+    orch.init_paths(config)
+    orch.client = client
+    orch._containers = {"nacl_f_default_box1": FakeContainer(client, "live")}
+    orch.commit_prepared(config["instances"][0])
+    repository, tag = orch.prepared_image(config["instances"][0]).split(":")
+    # the live container is only snapshotted, the key goes in a throwaway copy
+    assert client.calls == [
+        ("commit", "live", None, None, None),
+        ("wait", [nacl.orchestrators.MINION_PKI_DIR, "/etc/salt/minion_id"]),
+        ("commit", "snapshot", repository, tag, ["ENTRYPOINT []", 'CMD ["salt-minion"]']),
+        ("remove", "snapshot"),
+        ("remove_image", "snapshot"),
+    ]
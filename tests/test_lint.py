@@ -0,0 +1,52 @@
+import os
+
+import nacl.lint
+
+
+FAKE_SALT_LINT = """#!/bin/sh
+echo run >> "$CALLS"
+[ "$1" = "--version" ] && echo "salt-lint 0.9.2" && exit 0
+shift
+out=""
+for f in "$@"; do
+    if grep -q bad "$f"; then
+        out="$out{\\"id\\": \\"201\\", \\"message\\": \\"Trailing whitespace\\", \\"filename\\": \\"$f\\", \\"linenumber\\": 1, \\"line\\": \\"bad\\"},"
+    fi
+done
+echo "[${out%,}]"
+[ -n "$out" ] && exit 2
+exit 0
+"""
+
+
+def test_lint_tree(tmp_path, monkeypatch) -> None:
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    (bin_dir / "salt-lint").write_text(FAKE_SALT_LINT)
+    os.chmod(bin_dir / "salt-lint", 0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}:{os.environ['PATH']}")
+    monkeypatch.setenv("CALLS", f"{tmp_path}/calls")
+    monkeypatch.setattr(nacl.lint, "cache_path", lambda cur_dir: f"{tmp_path}/cache.json")
+    formula = tmp_path / "formula"
+    (formula / "nacl" / "default" / "pillar").mkdir(parents=True)
+    (formula / "web").mkdir()
+    (formula / "web" / "init.sls").write_text("good")
+    (formula / "web" / "app.sls").write_text("bad")
+    (formula / "web" / "map.jinja").write_text("bad")
+    (formula / "web" / ".draft.sls").write_text("bad")
+    (formula / "nacl" / "default" / "prepare.sls").write_text("bad")
+    (formula / "nacl" / "default" / "pillar" / "top.sls").write_text("bad")
+    (formula / "top.sls").write_text("bad")
+
+    result = nacl.lint.lint_tree(str(formula), workers=2)
+    assert result.files == ["web/app.sls", "web/init.sls"]
+    assert not result.passed
+    assert [x["id"] for x in result.matches["web/app.sls"]] == ["201"]
+
+    (formula / "web" / "app.sls").write_text("fine")
+    os.utime(formula / "web" / "init.sls")
+    open(f"{tmp_path}/calls", "w").close()
+    result = nacl.lint.lint_tree(str(formula), workers=2)
+    assert result.passed
+    assert result.cached == ["web/init.sls"]
+    assert len(open(f"{tmp_path}/calls").readlines()) == 2
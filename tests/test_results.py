@@ -0,0 +1,56 @@
+from nacl.results import parse_output, format_report
+import json
+
+STATE_RETURN = {
+    "pkg_|-vim_|-vim_|-installed": {
+        "__id__": "vim",
+        "__sls__": "editors",
+        "__run_num__": 1,
+        "name": "vim",
+        "result": True,
+        "changes": {"vim": {"old": "", "new": "9.0"}},
+        "duration": 1200.5,
+        "comment": "The following packages were installed",
+    },
+    "file_|-motd_|-/etc/motd_|-managed": {
+        "__id__": "motd",
+        "__sls__": "motd",
+        "__run_num__": 0,
+        "name": "/etc/motd",
+        "result": False,
+        "changes": {},
+        "duration": "3.1 ms",
+        "comment": "Source file salt://motd/files/motd not found",
+    },
+}
+
+
+def test_parse_output() -> None:
+    text = "[WARNING ] noise before\n" + json.dumps({"box1": STATE_RETURN}) + "\n"
+    text += json.dumps({"box2": ["Rendering SLS 'base:editors' failed"]})
+    minions = parse_output(text)
+    assert sorted(minions) == ["box1", "box2"]
+    box1 = minions["box1"]
+    assert [x.id for x in box1.states] == ["motd", "vim"]
+    assert [x.id for x in box1.failed] == ["motd"]
+    assert [x.id for x in box1.changed] == ["vim"]
+    assert [x.id for x in box1.pending] == ["vim"]
+    assert box1.states[0].function == "file.managed"
+    assert box1.states[0].duration == 3.1
+    assert minions["box2"].errors == ["Rendering SLS 'base:editors' failed"]
+    assert "Failed: 1" in format_report("box1", box1)
+
+
+def test_parse_salt_ssh_output() -> None:
+    text = json.dumps({"nacl_f_default_box1": {"return": STATE_RETURN, "retcode": 2}})
+    text += json.dumps({"nacl_f_default_box2": {"stdout": "", "stderr": "Permission denied", "retcode": 255}})
+    minions = parse_output(text)
+    assert len(minions["nacl_f_default_box1"].states) == 2
+    assert minions["nacl_f_default_box2"].errors == ["Permission denied"]
+
+
+def test_parse_dry_run_output() -> None:
+    state = dict(STATE_RETURN["pkg_|-vim_|-vim_|-installed"], result=None, changes={})
+    minions = parse_output(json.dumps({"box1": {"pkg_|-vim_|-vim_|-installed": state}}))
+    assert [x.id for x in minions["box1"].pending] == ["vim"]
+    assert minions["box1"].failed == []
@@ -0,0 +1,58 @@
+import fnmatch
+import os
+
+import pytest
+import yaml
+
+import nacl.orchestrators
+from nacl.exceptions import ConfigException
+
+
+def render_pillar(orch: nacl.orchestrators.Docker, minion_config: dict) -> dict:
+    # what the master compiles for a minion with pillarenv set: the first
+    # top.sls of the env's roots, and only its entries under that env
+    env = minion_config["pillarenv"]
+    roots = [
+        x.replace("/srv/salt/data/", orch.master_dir).replace("/srv/salt/formulas", orch.formula_dir)
+        for x in orch.master_config()["pillar_roots"][env]
+    ]
+
+    def find(name: str) -> str:
+        return next(f"{x}/{name}" for x in roots if os.path.exists(f"{x}/{name}"))
+
+    with open(find("top.sls")) as top_file:
+        top = yaml.safe_load(top_file)
+    pillar = {}
+    for target, names in top.get(env, {}).items():
+        if fnmatch.fnmatch(minion_config["id"], target):
+            for name in names:
+                with open(find(f"{name}.sls")) as sls:
+                    pillar.update(yaml.safe_load(sls))
+    return pillar
+
+
+def test_shared_master_pillar(tmp_path) -> None:
+    for scenario in ("default", "web"):
+        pillar_dir = f"{tmp_path}/formulas/f/nacl/{scenario}/pillar"
+        os.makedirs(pillar_dir)
+        with open(f"{pillar_dir}/top.sls", "w") as top:
+            top.write("base:\n  '*':\n    - default\n")
+        with open(f"{pillar_dir}/default.sls", "w") as default:
+            default.write(f"role: {scenario}\n")
+    config = {
+        "formula": "f",
+        "scenario": "web",
+        "running_tmp_dir": f"{tmp_path}/",
+        "master_config": {},
+        "shared_master": True,
+        "instances": [{"prov_name": "nacl_f_web_box1", "image": "centos"}],
+    }
+    orch = nacl.orchestrators.Docker.__new__(nacl.orchestrators.Docker)
+    orch.init_paths(config)
+    for scenario in orch.shared_scenarios():
+        orch.write_pillar_top(scenario)
+    _, minion_config = orch.minion_options(config["instances"][0])
+    assert render_pillar(orch, minion_config) == {"role": "web"}
+
+    with pytest.raises(ConfigException):
+        orch.init_paths(dict(config, master_config={"log_level": "debug"}))
@@ -0,0 +1,94 @@
+import nacl.sls
+import nacl.utils
+
+CONFIG = {
+    "formula": "web",
+    "scenario": "default",
+    "salt_exec_mode": "salt-master",
+    "master_config": {},
+    "instances": [{"prov_name": "nacl_web_default_box1", "image": "centos"}],
+}
+
+FILES = {
+    "init.sls": "include:\n  - .nginx\n  - .app\n",
+    "nginx.sls": "nginx_conf:\n  file.managed:\n    - source: salt://{{ tpldir }}/files/nginx.conf\n",
+    "app.sls": "app:\n  service.running:\n    - watch:\n      - file: nginx_conf\n",
+    "users.sls": "users: []\n",
+    "files/nginx.conf": "worker_processes 1;\n",
+    "nacl/default/pillar/top.sls": "base: {}\n",
+}
+
+
+def test_changed_states(tmp_path) -> None:
+    formula = tmp_path / "web"
+    for path, text in FILES.items():
+        (formula / path).parent.mkdir(parents=True, exist_ok=True)
+        (formula / path).write_text(text)
+    config = dict(CONFIG, running_tmp_dir=str(tmp_path / "nacl"))
+    instance = config["instances"][0]
+    nacl.utils.copy_srv_dir(config["running_tmp_dir"], "web", str(formula), "copy")
+    index = nacl.sls.SlsIndex(config)
+    assert index.changed_states(instance, "web") is None
+    index.record_applied(instance)
+    index.save()
+
+    (formula / "files/nginx.conf").write_text("worker_processes 2;\n")
+    nacl.utils.copy_srv_dir(config["running_tmp_dir"], "web", str(formula), "copy")
+    assert nacl.sls.SlsIndex(config).changed_states(instance, "web") == ["web.app", "web.nginx"]
+
+    (formula / "users.sls").write_text("users: [bob]\n")
+    nacl.utils.copy_srv_dir(config["running_tmp_dir"], "web", str(formula), "copy")
+    assert nacl.sls.SlsIndex(config).changed_states(instance, "web") == ["web.app", "web.nginx"]
+
+    index = nacl.sls.SlsIndex(config)
+    index.record_applied(instance)
+    index.save()
+    # app watches an id from nginx, it can't be applied without it
+    (formula / "app.sls").write_text(FILES["app.sls"] + "    - enable: True\n")
+    nacl.utils.copy_srv_dir(config["running_tmp_dir"], "web", str(formula), "copy")
+    assert nacl.sls.SlsIndex(config).changed_states(instance, "web") == ["web.app", "web.nginx"]
+
+    (formula / "nginx.sls").write_text(FILES["nginx.sls"] + "{% for x in ['a'] %}\nconf_{{ x }}:\n  file.managed: []\n{% endfor %}\n")
+    nacl.utils.copy_srv_dir(config["running_tmp_dir"], "web", str(formula), "copy")
+    assert nacl.sls.SlsIndex(config).changed_states(instance, "web") is None
+
+    (formula / "nacl/default/pillar/top.sls").write_text("base: {'*': [web]}\n")
+    nacl.utils.copy_srv_dir(config["running_tmp_dir"], "web", str(formula), "copy")
+    assert nacl.sls.SlsIndex(config).changed_states(instance, "web") is None
+
+
+def test_parse_sls_jinja() -> None:
+    entry = nacl.sls.parse_sls("include:\n  - {{ tplroot }}.config\n  - .service\n", "web/init.sls")
+    assert entry["includes"] == ["web.service"]
+    assert entry["dynamic"]
+
+    entry = nacl.sls.parse_sls("{{ p }}_pkg:\n  pkg.installed: []\n", "web/pkg.sls")
+    assert entry["ids"] == ["{{ p }}_pkg"]
+    assert entry["dynamic"]
+    assert nacl.sls.parse_sls("\"{{ sls }}-svc\":\n  service.running: []\n", "web/svc.sls")["dynamic"]
+
+    entry = nacl.sls.parse_sls("svc:\n  service.running:\n    - require:\n      - pkg: {{ map.pkg }}\n", "web/svc.sls")
+    assert entry["requires"] == []
+    assert entry["dynamic"]
+
+    entry = nacl.sls.parse_sls("svc:\n  service.running:\n    - name: {{ map.svc }}\n    - require:\n      - pkg: nginx\n", "web/svc.sls")
+    assert entry["requires"] == ["nginx"]
+    assert not entry["dynamic"]
+
+
+def test_changed_states_jinja_include(tmp_path) -> None:
+    formula = tmp_path / "web"
+    files = dict(FILES, **{"init.sls": "include:\n  - {{ tplroot }}.config\n", "config.sls": "conf:\n  file.managed: []\n"})
+    for path, text in files.items():
+        (formula / path).parent.mkdir(parents=True, exist_ok=True)
+        (formula / path).write_text(text)
+    config = dict(CONFIG, running_tmp_dir=str(tmp_path / "nacl"))
+    instance = config["instances"][0]
+    nacl.utils.copy_srv_dir(config["running_tmp_dir"], "web", str(formula), "copy")
+    index = nacl.sls.SlsIndex(config)
+    index.record_applied(instance)
+    index.save()
+
+    (formula / "config.sls").write_text("conf:\n  file.absent: []\n")
+    nacl.utils.copy_srv_dir(config["running_tmp_dir"], "web", str(formula), "copy")
+    assert nacl.sls.SlsIndex(config).changed_states(instance, "web") is None
@@ -0,0 +1,36 @@
+from nacl.state import StateStore, CREATED, PREPARED, CONVERGED, NOT_CREATED
+
+CONFIG = {
+    "provider": {"name": "docker"},
+    "formula": "nacl-test",
+    "scenario": "default",
+    "instances": [
+        {"prov_name": "nacl_nacl-test_default_box1", "image": "centos"},
+        {"prov_name": "nacl_nacl-test_default_box2", "image": "centos"},
+    ],
+}
+
+
+def test_state_store(tmp_path) -> None:
+    store = StateStore(f"{tmp_path}/state.db")
+    box1, box2 = CONFIG["instances"]
+    assert store.state(CONFIG, box1) == NOT_CREATED
+    store.set_state(CONFIG, box1, CREATED)
+    store.set_state(CONFIG, box1, CONVERGED, "abc")
+    store.set_state(CONFIG, box1, PREPARED)
+    row = store.get(CONFIG)["box1"]
+    assert row["state"] == PREPARED
+    assert row["formula_hash"] == "abc"
+    assert row["base"] == "centos"
+
+    store.set_verified(CONFIG, "box1", "test_default.py", "def")
+    assert store.verified(CONFIG, "box1", "test_default.py") == "def"
+    assert store.verified(CONFIG, "box2", "test_default.py") is None
+
+    store.reconcile(CONFIG, [("box1", NOT_CREATED), ("box2", "Created (not running)")])
+    assert sorted(store.get(CONFIG)) == ["box2"]
+    assert store.get(CONFIG)["box2"]["state"] == CREATED
+    # keyed on what was converged, not the machine, so it outlives a destroy
+    assert store.verified(CONFIG, "box1", "test_default.py") == "def"
+    store.remove_scenario(CONFIG)
+    assert store.get(CONFIG) == {}
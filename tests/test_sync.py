@@ -0,0 +1,51 @@
+from nacl.sync import sync_tree, load_manifest
+import os
+
+
+def write(path: str, data: str) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def test_sync_tree(tmp_path) -> None:
+    src = f"{tmp_path}/src"
+    dst = f"{tmp_path}/dst"
+    manifest = f"{tmp_path}/manifest.json"
+    write(f"{src}/init.sls", "pkg: []")
+    write(f"{src}/files/motd", "hello")
+    write(f"{src}/.git/HEAD", "ref")
+    result = sync_tree(src, dst, manifest, "copy")
+    assert sorted(result.added) == ["files/motd", "init.sls"]
+    assert not os.path.exists(f"{dst}/.git")
+    assert sorted(load_manifest(manifest)) == ["files/motd", "init.sls"]
+
+    assert not sync_tree(src, dst, manifest, "copy")
+
+    write(f"{src}/init.sls", "pkg: [vim]")
+    os.remove(f"{src}/files/motd")
+    result = sync_tree(src, dst, manifest, "copy")
+    assert result.changed == ["init.sls"]
+    assert result.removed == ["files/motd"]
+    assert not os.path.exists(f"{dst}/files")
+    with open(f"{dst}/init.sls") as f:
+        assert f.read() == "pkg: [vim]"
+
+
+def test_sync_tree_ignore_file(tmp_path) -> None:
+    src = f"{tmp_path}/src"
+    dst = f"{tmp_path}/dst"
+    write(f"{src}/.naclignore", "# artifacts\n*.log\nbuild/\n")
+    write(f"{src}/init.sls", "")
+    write(f"{src}/run.log", "")
+    write(f"{src}/build/out", "")
+    result = sync_tree(src, dst, f"{tmp_path}/manifest.json", "hardlink")
+    assert sorted(result.added) == [".naclignore", "init.sls"]
+
+
+def test_sync_tree_symlink_cycle(tmp_path) -> None:
+    src = f"{tmp_path}/src"
+    write(f"{src}/files/motd", "hello")
+    os.symlink(src, f"{src}/files/loop")
+    result = sync_tree(src, f"{tmp_path}/dst", f"{tmp_path}/manifest.json", "copy")
+    assert result.added == ["files/motd"]
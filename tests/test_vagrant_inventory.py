@@ -0,0 +1,47 @@
+import json
+import os
+import types
+
+import nacl.config
+import nacl.orchestrators
+import nacl.state
+
+CONFIG = {
+    "provider": {"name": "vagrant"},
+    "formula": "nacl-test",
+    "scenario": "default",
+    "instances": [
+        {"prov_name": "nacl_nacl-test_default_box1", "box": "centos"},
+        {"prov_name": "nacl_nacl-test_default_box2", "box": "centos"},
+    ],
+}
+
+
+def test_index_states(tmp_path, monkeypatch) -> None:
+    monkeypatch.setenv("VAGRANT_HOME", f"{tmp_path}/home")
+    monkeypatch.setattr(nacl.config, "TMP_DIR", f"{tmp_path}/nacl/")
+    config = dict(CONFIG, running_tmp_dir=f"{tmp_path}/")
+    orch = nacl.orchestrators.Vagrant(config)
+    project = os.path.normpath(orch.scenario_dir)
+    os.makedirs(f"{project}/.vagrant/machines/nacl_nacl-test_default_box1/virtualbox")
+    with open(f"{project}/.vagrant/machines/nacl_nacl-test_default_box1/virtualbox/id", "w") as id_file:
+        id_file.write("abc")
+    os.makedirs(f"{tmp_path}/home/data/machine-index")
+    with open(f"{tmp_path}/home/data/machine-index/index", "w") as index_file:
+        json.dump(
+            {"machines": {"abc": {"name": "nacl_nacl-test_default_box1", "state": "running", "vagrantfile_path": project}}},
+            index_file,
+        )
+    assert orch.index_states() == {
+        "nacl_nacl-test_default_box1": "running",
+        "nacl_nacl-test_default_box2": "not_created",
+    }
+
+    os.utime(f"{tmp_path}/home/data/machine-index/index", (0, 0))
+    assert orch.index_states() is None
+    open(f"{project}/Vagrantfile", "w").close()
+    statuses = [types.SimpleNamespace(name=x["prov_name"], state="poweroff") for x in CONFIG["instances"]]
+    monkeypatch.setattr(orch.vagrant, "status", lambda: statuses)
+    assert orch.get_inventory() == [("box1", "poweroff"), ("box2", "poweroff")]
+    monkeypatch.setattr(orch.vagrant, "status", lambda: [])
+    assert orch.get_inventory() == [("box1", "poweroff"), ("box2", "poweroff")]
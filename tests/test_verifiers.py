@@ -0,0 +1,114 @@
+import argparse
+import os
+import subprocess
+import types
+import xml.etree.ElementTree as ET
+
+import nacl.apply
+import nacl.cli
+import nacl.config
+import nacl.orchestrators
+import nacl.state
+from nacl.state import CONVERGED, CREATED
+import nacl.verifiers
+from nacl.verifiers import merge_junit, VerifyResult, VerifyRun
+
+
+def test_merge_junit(tmp_path) -> None:
+    (tmp_path / "box1.xml").write_text(
+        '<testsuites><testsuite name="pytest" tests="2" failures="1" errors="0" skipped="0"/></testsuites>'
+    )
+    (tmp_path / "box2.xml").write_text('<testsuite name="pytest" tests="3" failures="0" errors="1" skipped="1"/>')
+    (tmp_path / "broken.xml").write_text("<testsuites")
+    merge_junit([f"{tmp_path}/{x}.xml" for x in ("box1", "box2", "broken")], f"{tmp_path}/junit.xml")
+    root = ET.parse(f"{tmp_path}/junit.xml").getroot()
+    assert len(root.findall("testsuite")) == 2
+    assert (root.get("tests"), root.get("failures"), root.get("errors")) == ("5", "1", "1")
+
+    result = VerifyResult([VerifyRun("box1", "test_a.py", 0, ""), VerifyRun("box2", "test_a.py", 5, "")])
+    assert result.passed
+    result.runs.append(VerifyRun("box2", "test_b.py", 1, ""))
+    assert [x.tests for x in result.failed] == ["test_b.py"]
+
+
+def test_testinfra_test_files(tmp_path, monkeypatch) -> None:
+    config = {"formula": "f", "scenario": "default", "running_tmp_dir": f"{tmp_path}/"}
+    orch = types.SimpleNamespace(scenario_dir=f"{tmp_path}/docker/", connection_type="docker", get_inventory=lambda: [("box1", "Converged")])
+    veri = nacl.verifiers.Testinfra(config, orch)
+    assert veri.test_files() == ["tests"]
+    for path in ("tests/test_a.py", "tests/web/test_b.py", "tests/web/helpers.py", "conftest.py"):
+        os.makedirs(os.path.dirname(f"{veri.scenario_path}/{path}"), exist_ok=True)
+        open(f"{veri.scenario_path}/{path}", "w").close()
+    assert veri.test_files() == ["tests/test_a.py", "tests/web/test_b.py"]
+
+    row = {"state": CONVERGED, "formula_hash": "abc", "name": "box1", "provider": "docker", "base": "centos", "created_at": 1.0}
+    before = veri.fingerprint(row, "tests/test_a.py")
+    with open(f"{veri.scenario_path}/tests/web/test_b.py", "w") as test_file:
+        test_file.write("def test_b(): pass")
+    assert veri.fingerprint(row, "tests/test_a.py") == before
+    with open(f"{veri.scenario_path}/conftest.py", "w") as conftest:
+        conftest.write("import pytest")
+    assert veri.fingerprint(row, "tests/test_a.py") != before
+
+    calls = []
+    monkeypatch.setattr(subprocess, "run", lambda cmd, **kwargs: calls.append((cmd, kwargs["cwd"])) or types.SimpleNamespace(returncode=0))
+    monkeypatch.setattr(nacl.apply, "log_dir", lambda config: str(tmp_path))
+    run = veri.run_one("docker://nacl_f_default_box1", "tests/web/test_b.py", str(tmp_path))
+    assert calls[0][0].endswith(" tests/web/test_b.py") and calls[0][1] == veri.scenario_path
+    assert run.log_file == f"{tmp_path}/verify-box1-web-test_b.log"
+
+
+class FakeOrchestrator(nacl.orchestrators.Orchestrator):
+    connection_type = "docker"
+
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        self.scenario_dir = f"{config['running_tmp_dir']}docker/{config['formula']}/{config['scenario']}/nacl/"
+        self.created = False
+
+    def orchestrate(self) -> dict[str, str]:
+        os.makedirs(self.scenario_dir, exist_ok=True)
+        self.created = True
+        return {"box1": CREATED}
+
+    def cleanup(self) -> None:
+        self.created = False
+        nacl.state.StateStore().remove_scenario(self.config)
+
+    def get_inventory(self) -> list[tuple[str, str]]:
+        return [("box1", nacl.state.StateStore().state(self.config, self.config["instances"][0]) if self.created else "Not created")]
+
+    def login(self, host: str) -> None:
+        pass
+
+
+def test_verify_cached_across_destroy(tmp_path, monkeypatch) -> None:
+    formula = tmp_path / "f"
+    (formula / "nacl/default/tests").mkdir(parents=True)
+    (formula / "init.sls").write_text("pkg: {}\n")
+    (formula / "nacl/default/tests/test_a.py").write_text("def test_a(): pass\n")
+    monkeypatch.setattr(nacl.config, "TMP_DIR", f"{tmp_path}/nacl/")
+    config = {
+        "formula": "f",
+        "scenario": "default",
+        "running_tmp_dir": f"{tmp_path}/nacl/",
+        "provider": {"name": "docker"},
+        "salt_exec_mode": "salt-master",
+        "sync_mode": "copy",
+        "verifier": "testinfra",
+        "instances": [{"prov_name": "nacl_f_default_box1", "image": "centos"}],
+    }
+    orch = FakeOrchestrator(config)
+    monkeypatch.setattr(nacl.apply, "apply_states", lambda config, orch, instances, *args, **kwargs: {
+        x["prov_name"].split("_")[-1]: types.SimpleNamespace(succeeded=True) for x in instances
+    })
+    monkeypatch.setattr(nacl.apply, "log_dir", lambda config: str(tmp_path))
+    calls = []
+    monkeypatch.setattr(subprocess, "run", lambda cmd, **kwargs: calls.append(cmd) or types.SimpleNamespace(returncode=0))
+
+    args = argparse.Namespace()
+    for _ in range(2):
+        nacl.cli.destroy(args, config, orch)
+        nacl.cli.converge(args, str(formula), config, orch)
+        nacl.cli.verify(args, config, orch)
+    assert len(calls) == 1